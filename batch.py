@@ -0,0 +1,165 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from llm_api import generate_prompts, provider_for, resolve_auto
+from tag_pipeline import apply_prompt_settings
+from rate_limit import temporary_rate_limit
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+config_path = os.path.join(base_dir, "config.json")
+presets_path = os.path.join(base_dir, "presets.json")
+
+# Fields tried in order when the input field is not given explicitly
+INPUT_FIELDS = ["user_input", "input", "text", "prompt", "body"]
+ID_FIELDS = ["id", "request_id"]
+
+def _first_field(record, names):
+    for name in names:
+        # 0 is a valid id; only missing and empty values fall through
+        if record.get(name) not in (None, ""):
+            return record[name]
+    return None
+
+def read_requests(input_path, input_field=None, id_field=None):
+    requests = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except Exception as e:
+                print(f"[AIPI] Skipping invalid JSON on line {line_no} of {input_path}: {e}")
+                continue
+            if isinstance(record, str):
+                record = {"user_input": record}
+            text = record.get(input_field) if input_field else _first_field(record, INPUT_FIELDS)
+            if not text:
+                print(f"[AIPI] Skipping line {line_no} of {input_path}: no input text")
+                continue
+            request_id = record.get(id_field) if id_field else _first_field(record, ID_FIELDS)
+            requests.append((str(request_id if request_id is not None else line_no), text))
+    return requests
+
+def read_completed(output_path):
+    # Ids that already have a successful result, so a crashed run can pick up where it stopped
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except Exception:
+                continue # A partially written last line from a crash
+            if not record.get("error"):
+                completed.add(str(record.get("id")))
+    return completed
+
+def iter_batch(input_path, output_path, llm_type, api_key, workers=4, requests_per_minute=None, input_field=None, id_field=None, resume=True, use_cache=True, api_keys=None, prompt_settings_enabled=False, quality_tags_enabled=False, qt_prompt="", bottom_mandatory_enabled=False, bm_prompt=""):
+    # Yields (record, done, total) as each request finishes; records are appended to output_path immediately
+    requests = read_requests(input_path, input_field, id_field)
+    completed = read_completed(output_path) if resume else set()
+    pending = [(request_id, text) for request_id, text in requests if request_id not in completed]
+    total = len(requests)
+    done = total - len(pending)
+
+    # Auto is resolved once, so the whole batch goes to one model and one key's rate limit
+    llm_type, api_key, model, resolve_error = resolve_auto(llm_type, api_key, api_keys)
+    quality_tags = qt_prompt if (prompt_settings_enabled and quality_tags_enabled) else None
+    write_lock = threading.Lock()
+
+    def run_one(request_id, text):
+        if resolve_error:
+            data, error = None, resolve_error
+        else:
+            try:
+                data, error = generate_prompts(llm_type, api_key, text, use_cache=use_cache, model=model, quality_tags=quality_tags)
+            except Exception as e:
+                data, error = None, f"Unexpected error: {e}"
+        record = {"id": request_id, "user_input": text, "llm_type": llm_type}
+        if error:
+            record["error"] = error
+        else:
+            record["positive"] = apply_prompt_settings(data.get("positive", ""), prompt_settings_enabled, quality_tags_enabled, qt_prompt, bottom_mandatory_enabled, bm_prompt)
+            record["negative"] = data.get("negative", "")
+            record["pos_mapping"] = data.get("pos_mapping", [])
+            record["neg_mapping"] = data.get("neg_mapping", [])
+        return record
+
+    # Workers share the per-key token bucket with the UI, so queueing and 429 backoff are global;
+    # a requested rate only applies while the batch runs
+    rate_limit = temporary_rate_limit(provider_for(llm_type), api_key, requests_per_minute) if requests_per_minute and not resolve_error else contextlib.nullcontext()
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with rate_limit, open(output_path, "a" if resume else "w", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(run_one, request_id, text) for request_id, text in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            with write_lock:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+            done += 1
+            yield record, done, total
+
+def run_batch(*args, **kwargs):
+    succeeded = failed = 0
+    for record, done, total in iter_batch(*args, **kwargs):
+        if record.get("error"):
+            failed += 1
+            print(f"[AIPI] [{done}/{total}] {record['id']}: {record['error']}")
+        else:
+            succeeded += 1
+            print(f"[AIPI] [{done}/{total}] {record['id']}: OK")
+    return succeeded, failed
+
+def _load_json(path):
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f) or {}
+        except Exception as e:
+            print(f"[AIPI] Error loading JSON from {path}: {e}")
+    return {}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Stable Diffusion prompts for every request in a JSONL file.")
+    parser.add_argument("input", help="Input JSONL with one request per line")
+    parser.add_argument("output", help="Output JSONL; results are appended as they finish")
+    parser.add_argument("--llm", default=None, help="LLM type as shown in the AIPI tab (default: value from config.json)")
+    parser.add_argument("--api-key", default=None, help="API key (default: key for the provider from config.json)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rpm", type=float, default=None, help="Requests per minute for the API key (default: provider default from rate_limit.py)")
+    parser.add_argument("--field", default=None, help="Input text field (default: first of " + ", ".join(INPUT_FIELDS) + ")")
+    parser.add_argument("--id-field", default=None)
+    parser.add_argument("--quality-tags", default=None, help="Fixed quality tags, or a preset name from presets.json")
+    parser.add_argument("--bottom-tags", default=None, help="Bottom mandatory tags, or a preset name from presets.json")
+    parser.add_argument("--no-resume", action="store_true", help="Overwrite the output instead of skipping finished ids")
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args(argv)
+
+    config = _load_json(config_path)
+    presets = _load_json(presets_path)
+    llm_type = args.llm or config.get("llm_type", "Gemini 3.0")
+    api_keys = {provider: config.get(f"{provider}_key", "") for provider in ("gemini", "openai", "grok")}
+    api_key = args.api_key or api_keys.get(provider_for(llm_type), "")
+    qt_prompt = presets.get("quality_tags", {}).get(args.quality_tags, args.quality_tags) if args.quality_tags else ""
+    bm_prompt = presets.get("bottom_mandatory", {}).get(args.bottom_tags, args.bottom_tags) if args.bottom_tags else ""
+
+    succeeded, failed = run_batch(
+        args.input, args.output, llm_type, api_key,
+        workers=args.workers, requests_per_minute=args.rpm, input_field=args.field, id_field=args.id_field,
+        resume=not args.no_resume, use_cache=not args.no_cache, api_keys=api_keys,
+        prompt_settings_enabled=bool(qt_prompt or bm_prompt), quality_tags_enabled=bool(qt_prompt), qt_prompt=qt_prompt,
+        bottom_mandatory_enabled=bool(bm_prompt), bm_prompt=bm_prompt,
+    )
+    print(f"[AIPI] Batch finished: {succeeded} succeeded, {failed} failed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
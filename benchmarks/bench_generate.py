@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm_server import FakeLLMServer, add_settings_arguments, settings_from_args
+
+import metrics
+from llm_api import generate_prompts, generate_prompts_stream, generate_prompts_async, generate_prompts_stream_async, generate_variants_async, generate_queue
+from llm_providers import set_base_url, provider_for_llm_type
+from rate_limit import set_rate_limit
+from response_cache import response_cache
+from router import model_router
+from tag_dictionary import tag_dictionary
+from tag_pipeline import apply_prompt_settings
+
+# Load/latency benchmark of the generate path against benchmarks/fake_llm_server.py.
+# Every session runs what on_generate runs: generate (optionally streamed), then tag post-processing.
+# By default sessions are threads on the sync entry points; --async runs them as tasks on one event loop
+# through the async entry points and the generate queue, exactly like the UI handler.
+#
+#   python benchmarks/bench_generate.py --llm ChatGPT "Gemini 2.0" --sessions 1 8 32 --requests 20
+#   python benchmarks/bench_generate.py --async --stream --sessions 32 --queue-limit 32
+
+FAKE_API_KEY = "fake-key"
+QT_PROMPT = "masterpiece, best quality"
+BM_PROMPT = "detailed background"
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+def postprocess(data):
+    with metrics.span("tag_postprocess"):
+        for variant in data.get("variants", [data]):
+            apply_prompt_settings(variant.get("positive", ""), True, True, QT_PROMPT, True, BM_PROMPT)
+
+def one_request(llm, text, session_id, stream):
+    if stream:
+        data, error = None, "no result"
+        for kind, value in generate_prompts_stream(llm, FAKE_API_KEY, text, use_cache=False, session_id=session_id, quality_tags=QT_PROMPT):
+            if kind == "result":
+                data, error = value
+    else:
+        data, error = generate_prompts(llm, FAKE_API_KEY, text, use_cache=False, session_id=session_id, quality_tags=QT_PROMPT)
+    if not error:
+        postprocess(data)
+    return error
+
+async def one_request_async(llm, text, session_id, stream, variants=1):
+    # Same steps as on_generate: a slot from the generate queue, then the async entry point
+    queue = generate_queue.enter()
+    try:
+        with metrics.span("queue_wait"):
+            async for _ in queue:
+                pass
+    finally:
+        await queue.aclose()
+    try:
+        if variants > 1:
+            data, error = await generate_variants_async(llm, FAKE_API_KEY, text, variants, use_cache=False, session_id=session_id, quality_tags=QT_PROMPT)
+        elif stream:
+            data, error = None, "no result"
+            async for kind, value in generate_prompts_stream_async(llm, FAKE_API_KEY, text, use_cache=False, session_id=session_id, quality_tags=QT_PROMPT):
+                if kind == "result":
+                    data, error = value
+        else:
+            data, error = await generate_prompts_async(llm, FAKE_API_KEY, text, use_cache=False, session_id=session_id, quality_tags=QT_PROMPT)
+    finally:
+        generate_queue.leave()
+    if not error:
+        postprocess(data)
+    return error
+
+def request_text(llm, sessions, index, n):
+    # Distinct inputs so that identical-request coalescing does not hide the load
+    return f"bench {llm} {sessions} {index} {n}"
+
+def run_load(llm, sessions, requests, stream):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def session(index):
+        for n in range(requests):
+            started = time.perf_counter()
+            error = one_request(llm, request_text(llm, sessions, index, n), f"bench-{index}", stream)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if error:
+                    errors.append(error)
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(sessions)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors, time.perf_counter() - started
+
+def run_load_async(loop, llm, sessions, requests, stream, variants=1):
+    # One event loop for the whole benchmark, since pooled async clients belong to the loop they were opened on
+    latencies = []
+    errors = []
+
+    async def session(index):
+        for n in range(requests):
+            started = time.perf_counter()
+            error = await one_request_async(llm, request_text(llm, sessions, index, n), f"bench-{index}", stream, variants)
+            latencies.append(time.perf_counter() - started)
+            if error:
+                errors.append(error)
+
+    async def run():
+        await asyncio.gather(*(session(i) for i in range(sessions)))
+
+    started = time.perf_counter()
+    loop.run_until_complete(run())
+    return latencies, errors, time.perf_counter() - started
+
+def print_stages(snapshot):
+    stages = snapshot["stages"]
+    if not stages:
+        return
+    print(f"    {'stage':<18} {'count':>7} {'mean ms':>10} {'total s':>9}")
+    for name, stage in sorted(stages.items(), key=lambda kv: -kv[1]["total"]):
+        print(f"    {name:<18} {stage['count']:>7} {stage['total'] / stage['count'] * 1000:>10.2f} {stage['total']:>9.2f}")
+    if snapshot["counters"]:
+        print("    " + ", ".join(f"{k}={v}" for k, v in sorted(snapshot["counters"].items())))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the generate path against a local fake LLM server")
+    parser.add_argument("--llm", nargs="+", default=["ChatGPT", "Gemini 2.0"], help="LLM selections to benchmark")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 8, 32], help="concurrent sessions")
+    parser.add_argument("--requests", type=int, default=10, help="requests per session")
+    parser.add_argument("--stream", action="store_true", help="use the streaming path")
+    parser.add_argument("--variants", type=int, default=1, help="prompt variants per request (> 1 uses generate_variants_async and implies --async)")
+    parser.add_argument("--rpm", type=int, default=100000, help="per-key rate limit during the run (0 = provider defaults)")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run sessions on one event loop through the async entry points, like the UI")
+    parser.add_argument("--queue-limit", type=int, default=generate_queue.limit, help="concurrent generates allowed by the queue in --async mode")
+    parser.add_argument("--server", help="use an already running fake server at this URL instead of starting one")
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    # generate_variants_async needs an event loop, and pooled async clients are keyed by loop, so variants
+    # only run on the shared loop of --async rather than on a throwaway loop per request
+    args.use_async = args.use_async or args.variants > 1
+
+    server = None
+    url = args.server
+    if not url:
+        server = FakeLLMServer(settings=settings_from_args(args)).start()
+        url = server.url
+    set_base_url("openai", url + "/v1")
+    set_base_url("grok", url + "/v1")
+    set_base_url("gemini", url)
+
+    # Keep the benchmark's cache, router and dictionary state out of the extension directory
+    state_dir = tempfile.mkdtemp(prefix="aipi-bench-")
+    response_cache.path = os.path.join(state_dir, "response_cache.sqlite3")
+    model_router.path = os.path.join(state_dir, "router_stats.json")
+    tag_dictionary.path = os.path.join(state_dir, "tag_dictionary.json")
+    metrics.metrics_path = os.path.join(state_dir, "metrics.jsonl")
+    metrics.set_enabled(True)
+
+    generate_queue.limit = args.queue_limit
+    loop = asyncio.new_event_loop() if args.use_async else None
+
+    print(f"Fake server: {url} (latency {args.latency}s, errors {args.error_rate:.0%}, 429 {args.rate_limit_rate:.0%}, stream={args.stream}, variants={args.variants}, "
+          + (f"async, queue limit {args.queue_limit})" if args.use_async else "threads)"))
+    try:
+        for llm in args.llm:
+            if args.rpm:
+                set_rate_limit(provider_for_llm_type(llm).name, FAKE_API_KEY, args.rpm, args.rpm)
+            for sessions in args.sessions:
+                metrics.reset()
+                if args.use_async:
+                    latencies, errors, wall = run_load_async(loop, llm, sessions, args.requests, args.stream, args.variants)
+                else:
+                    latencies, errors, wall = run_load(llm, sessions, args.requests, args.stream)
+                print(f"\n{llm}, {sessions} sessions x {args.requests} requests")
+                print(f"    p50 {percentile(latencies, 50) * 1000:.1f} ms  p95 {percentile(latencies, 95) * 1000:.1f} ms  p99 {percentile(latencies, 99) * 1000:.1f} ms")
+                print(f"    throughput {len(latencies) / wall:.1f} req/s, errors {len(errors)}/{len(latencies)}")
+                if errors:
+                    print(f"    first error: {errors[0]}")
+                snapshot = metrics.snapshot()
+                prompt_tokens = snapshot["counters"].get("prompt_tokens", 0)
+                if prompt_tokens:
+                    print(f"    prompt tokens served from the provider's prompt cache: {snapshot['counters'].get('cached_tokens', 0) / prompt_tokens:.0%}")
+                llm_time = snapshot["stages"].get("llm_call", {}).get("total", 0.0)
+                if latencies and args.variants == 1:
+                    # Time spent outside the provider call (cache, coalescing, parsing, post-processing)
+                    print(f"    overhead per request {(sum(latencies) - llm_time) / len(latencies) * 1000:.2f} ms")
+                print_stages(snapshot)
+    finally:
+        if loop is not None:
+            loop.close()
+        if server is not None:
+            print(f"\nServer stats: {server.stats}")
+            server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_store import HistoryStore, SCHEMA, normalize, make_settings_key
+
+# Lookup latency of the generation history with a large synthetic table.
+#
+#   python benchmarks/bench_history.py --entries 100000 --queries 2000
+
+SUBJECTS = ["少女", "少年", "猫耳の少女", "騎士", "魔法使い", "メイド", "巫女", "侍", "ロボット", "ドラゴン", "妖精", "吸血鬼", "天使", "海賊", "忍者", "アイドル"]
+HAIR = ["長い銀髪の", "短い黒髪の", "金髪ツインテールの", "赤いポニーテールの", "青いボブヘアの", "ピンクの巻き髪の", "白髪の", "茶髪の"]
+PLACES = ["桜並木の下で", "夜の東京で", "雪の森で", "海辺の夕暮れに", "図書館で", "雨の路地裏で", "宇宙ステーションで", "教室で", "神社の境内で", "砂漠で", "花畑で", "城の玉座で"]
+ACTIONS = ["微笑んでいる", "剣を構えている", "本を読んでいる", "踊っている", "空を見上げている", "走っている", "眠っている", "歌っている", "振り返っている", "紅茶を飲んでいる"]
+STYLES = ["", "、水彩風", "、アニメ調", "、油絵風", "、逆光", "、全身", "、バストアップ", "、高画質", "、映画のワンシーン風", "、ドラマチックな照明"]
+
+def make_request(rng):
+    return f"{rng.choice(HAIR)}{rng.choice(SUBJECTS)}が{rng.choice(PLACES)}{rng.choice(ACTIONS)}{rng.choice(STYLES)}{rng.choice(STYLES)}"
+
+def perturb(text, rng):
+    # The kinds of differences that should still find the earlier result
+    choice = rng.randrange(3)
+    if choice == 0:
+        return text.replace("、", "， ")
+    if choice == 1:
+        return " ".join(text) # Spaces between every character
+    return text.translate(str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789", "ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺａｂｃｄｅｆｇｈｉｊｋｌｍｎｏｐｑｒｓｔｕｖｗｘｙｚ０１２３４５６７８９")) + "。"
+
+def typo(text, rng):
+    # One character replaced, which normalization does not undo
+    i = rng.randrange(len(text))
+    return text[:i] + rng.choice("のがをにでと") + text[i + 1:]
+
+def build(path, entries, rng):
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    settings_key = make_settings_key("Gemini 2.0", None)
+    result = json.dumps({"positive": "masterpiece, 1girl", "negative": "lowres", "pos_mapping": [], "neg_mapping": []})
+    rows = []
+    for n in range(entries):
+        text = make_request(rng) + (f" {n}" if rng.random() < 0.5 else "")
+        rows.append((time.time(), text, normalize(text), settings_key, "{}", result))
+    db.executemany("INSERT INTO history (created, user_input, normalized, settings_key, settings, result) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    db.commit()
+    db.close()
+    return [r[1] for r in rows]
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+def timed(fn, queries):
+    latencies = []
+    found = 0
+    for q in queries:
+        started = time.perf_counter()
+        result = fn(q)
+        latencies.append(time.perf_counter() - started)
+        found += bool(result)
+    return latencies, found
+
+def report(name, latencies, found):
+    print(f"  {name:<24} p50 {percentile(latencies, 50) * 1e6:8.1f} us  p99 {percentile(latencies, 99) * 1e6:8.1f} us  max {max(latencies) * 1e6:8.1f} us  found {found}/{len(latencies)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark history lookups")
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    path = os.path.join(tempfile.mkdtemp(prefix="aipi-history-"), "history.sqlite3")
+    texts = build(path, args.entries, rng)
+    store = HistoryStore(path)
+    started = time.perf_counter()
+    store.warm()
+    print(f"{args.entries} entries ({store.stats()['distinct']} distinct), index built in {time.perf_counter() - started:.2f} s")
+
+    settings_key = make_settings_key("Gemini 2.0", None)
+    repeats = [perturb(rng.choice(texts), rng) for _ in range(args.queries)]
+    originals = [rng.choice(texts) for _ in range(args.queries)]
+    typos = [typo(text, rng) for text in originals]
+    novel = [make_request(rng) + "、" + rng.choice(PLACES) for _ in range(args.queries)]
+    report("exact (perturbed)", *timed(lambda q: store._exact.get((normalize(q), settings_key)), repeats))
+    report("similar (typo)", *timed(store.similar, typos))
+    report("similar (novel)", *timed(store.similar, novel))
+    report("search (short query)", *timed(lambda q: store._search(normalize(q), 50), [rng.choice(SUBJECTS) + "が" for _ in range(args.queries)]))
+    # Near duplicate lookups are approximate; how often the request that was mistyped comes back
+    checked = min(200, len(typos))
+    found = 0
+    for original, q in zip(originals[:checked], typos[:checked]):
+        entries = store.get_many([entry_id for _, entry_id in store.similar(q)])
+        found += any(e["user_input"] == original for e in entries)
+    print(f"  similar (typo) returned the original for {found}/{checked} queries")
+
+if __name__ == "__main__":
+    main()
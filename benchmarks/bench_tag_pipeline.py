@@ -0,0 +1,107 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tag_pipeline import apply_prompt_settings, compile_rules, COMMON_QUALITY_TAGS
+
+# Micro-benchmark for the quality-tag / bottom-mandatory post-processing on large prompts.
+# The previous on_generate implementation is kept below as the baseline.
+
+def legacy_apply_prompt_settings(pos, prompt_settings_enabled, quality_tags_enabled, qt_prompt, bottom_mandatory_enabled, bm_prompt):
+    # Apply Prompt Settings only if master toggle is enabled
+    if prompt_settings_enabled:
+        # 1. Quality Tags filtering (Final client-side check)
+        if quality_tags_enabled and qt_prompt:
+            input_quality_tags = [t.strip() for t in qt_prompt.split(",") if t.strip()]
+            common_quality_tags = COMMON_QUALITY_TAGS
+            pos_tags = [t.strip() for t in pos.split(",")]
+            filtered_tags = []
+            quality_tags_to_prepend = []
+
+            # Identify quality tags to keep
+            for t in pos_tags:
+                t_lower = t.lower()
+                is_quality = any(q in t_lower for q in common_quality_tags)
+                if is_quality:
+                    # Keep only if it's one of the explicitly requested tags
+                    if any(it.lower() in t_lower for it in input_quality_tags):
+                        quality_tags_to_prepend.append(t)
+                else:
+                    filtered_tags.append(t)
+            
+            # Ensure all input quality tags are in the prepend list
+            for it in input_quality_tags:
+                if not any(it.lower() in q.lower() for q in quality_tags_to_prepend):
+                    quality_tags_to_prepend.insert(0, it)
+            
+            # Prepend all quality tags
+            pos = ", ".join(quality_tags_to_prepend + filtered_tags)
+        
+        else:
+            # Even if quality_tags_enabled is False, move common quality tags to the beginning
+            common_quality_tags = COMMON_QUALITY_TAGS
+            pos_tags = [t.strip() for t in pos.split(",") if t.strip()]
+            quality_part = []
+            content_part = []
+            for t in pos_tags:
+                if any(q in t.lower() for q in common_quality_tags):
+                    quality_part.append(t)
+                else:
+                    content_part.append(t)
+            pos = ", ".join(quality_part + content_part)
+
+        # 2. Bottom Mandatory
+        if bottom_mandatory_enabled and bm_prompt:
+            bm_tags = [t.strip() for t in bm_prompt.split(",") if t.strip()]
+            pos_tags = [t.strip() for t in pos.split(",")]
+            # Remove duplicates from current pos
+            pos_tags = [t for t in pos_tags if not any(bt.lower() == t.lower() for bt in bm_tags)]
+            # Append bm_tags
+            pos = ", ".join(pos_tags + bm_tags)
+
+    return pos
+
+CONTENT_WORDS = ["1girl", "solo", "long hair", "blue eyes", "smile", "school uniform", "cherry blossoms", "outdoors",
+                 "looking at viewer", "upper body", "sky", "cloud", "day", "wind", "skirt", "ribbon", "blush", "sunlight"]
+
+def make_prompt(n_tags, rng):
+    tags = COMMON_QUALITY_TAGS[:]
+    tags += [f"{rng.choice(CONTENT_WORDS)} {i}" for i in range(n_tags)]
+    rng.shuffle(tags)
+    return ", ".join(tags)
+
+def bench(fn, prompts, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for p in prompts:
+            fn(p)
+        best = min(best, time.perf_counter() - started)
+    return best / len(prompts)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tag post-processing")
+    parser.add_argument("--tags", type=int, nargs="+", default=[20, 100, 500, 2000])
+    parser.add_argument("--prompts", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    qt = "masterpiece, best quality, ultra high res, " + ", ".join(f"quality{i}" for i in range(20))
+    bm = ", ".join(f"bottom tag {i}" for i in range(20))
+    settings = (True, True, qt, True, bm)
+
+    print(f"{'tags':>6} {'legacy us':>12} {'compiled us':>12} {'speedup':>8}")
+    for n in args.tags:
+        prompts = [make_prompt(n, rng) for _ in range(args.prompts)]
+        compile_rules.cache_clear()
+        legacy = bench(lambda p: legacy_apply_prompt_settings(p, *settings), prompts, args.repeat)
+        compiled = bench(lambda p: apply_prompt_settings(p, *settings), prompts, args.repeat)
+        print(f"{n:>6} {legacy * 1e6:>12.1f} {compiled * 1e6:>12.1f} {legacy / compiled:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
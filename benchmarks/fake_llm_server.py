@@ -0,0 +1,373 @@
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI-compatible and Gemini REST APIs, so the request path can be
+# benchmarked offline without spending quota. Only what this extension calls is implemented:
+#   POST /v1/chat/completions                      (OpenAI / xAI, JSON or SSE stream)
+#   GET  /v1beta/models                            (Gemini list_models)
+#   POST /v1beta/models/{model}:generateContent     (Gemini)
+#   POST /v1beta/models/{model}:streamGenerateContent (Gemini, streamed JSON array)
+#   POST /v1beta/cachedContents                    (Gemini context caching)
+#   DELETE /v1beta/cachedContents/{id}
+# Usage metadata reports cached prompt tokens the way the real APIs do: a system prefix seen before
+# (or a Gemini cached content) counts as cached once it reaches min_cache_tokens.
+
+TAGS = ["masterpiece", "best quality", "1girl", "solo", "long hair", "blue eyes", "smile", "school uniform",
+        "cherry blossoms", "outdoors", "looking at viewer", "upper body", "sky", "cloud", "day", "wind",
+        "skirt", "ribbon", "blush", "sunlight", "petals", "tree", "hair ornament", "pleated skirt"]
+NEGATIVE_TAGS = ["lowres", "bad anatomy", "bad hands", "text", "error", "missing fingers", "worst quality", "blurry"]
+GEMINI_MODELS = ["gemini-3.0-pro", "gemini-3.0-flash", "gemini-2.0-flash", "gemini-2.0-flash-exp", "gemini-1.5-flash", "gemini-1.5-pro"]
+
+_GEMINI_PATH = re.compile(r"^/v1beta/models/([^:/]+):(generateContent|streamGenerateContent)")
+_VARIANTS = re.compile(r"Generate (\d+) clearly different variants")
+
+class FakeLLMSettings:
+    def __init__(self, latency=0.2, jitter=0.05, error_rate=0.0, rate_limit_rate=0.0, retry_after=0.1,
+                 stream_chunks=8, chunk_delay=0.02, tags=24, missing_models=(), max_variants=0, min_cache_tokens=1024, schemaless_models=()):
+        self.latency = latency # Seconds before the first byte
+        self.jitter = jitter
+        self.error_rate = error_rate # Share of requests answered with 500
+        self.rate_limit_rate = rate_limit_rate # Share of requests answered with 429 + Retry-After
+        self.retry_after = retry_after
+        self.stream_chunks = stream_chunks
+        self.chunk_delay = chunk_delay
+        self.tags = tags # Positive tags per response
+        self.missing_models = set(missing_models) # Gemini models answered with 404
+        self.max_variants = max_variants # Cap on variants per response, like a model hitting its output limit (0 = none)
+        self.min_cache_tokens = min_cache_tokens # Smallest prefix the prompt caches accept
+        self.schemaless_models = set(schemaless_models) # OpenAI-compatible models answering json_schema response formats with 400
+
+def make_pair(tags, variant=None):
+    positive = [TAGS[i % len(TAGS)] if i < len(TAGS) else f"{TAGS[i % len(TAGS)]} {i}" for i in range(tags)]
+    if variant is not None:
+        positive[-1] = f"pose {variant}"
+    return {
+        "positive": ", ".join(positive),
+        "negative": ", ".join(NEGATIVE_TAGS),
+        "pos_mapping": [{"word": t, "translation": f"訳{i}"} for i, t in enumerate(positive)],
+        "neg_mapping": [{"word": t, "translation": f"負{i}"} for i, t in enumerate(NEGATIVE_TAGS)],
+    }
+
+def make_content(tags, prompt="", max_variants=0):
+    # Multi-variant prompts get {"variants": [...]}, each variant with a tag of its own
+    match = _VARIANTS.search(prompt)
+    if not match:
+        return json.dumps(make_pair(tags), ensure_ascii=False)
+    count = int(match.group(1))
+    if max_variants:
+        count = min(count, max_variants)
+    base = random.randrange(1_000_000)
+    return json.dumps({"variants": [make_pair(tags, base + i) for i in range(count)]}, ensure_ascii=False)
+
+def _content_text(content):
+    return "".join(p.get("text", "") for p in (content or {}).get("parts") or [])
+
+def request_text(body):
+    # Prompt text of an OpenAI or Gemini request body
+    parts = [m.get("content") for m in body.get("messages") or [] if isinstance(m.get("content"), str)]
+    parts.append(_content_text(body.get("systemInstruction")))
+    parts.extend(_content_text(c) for c in body.get("contents") or [])
+    return "\n".join(parts)
+
+def system_text(body):
+    # The cacheable prefix: the OpenAI system message or the Gemini system instruction
+    for m in body.get("messages") or []:
+        if m.get("role") == "system":
+            return m.get("content") or ""
+    return _content_text(body.get("systemInstruction"))
+
+def count_tokens(text):
+    return len(text) // 4
+
+def split_text(text, parts):
+    size = max(1, -(-len(text) // max(1, parts)))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real APIs
+    server_version = "FakeLLM/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def settings(self):
+        return self.server.settings
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(raw or b"{}")
+        except ValueError:
+            return {}
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _simulate(self):
+        # Returns an error response that was sent, or None when the request should succeed
+        s = self.settings
+        self.server.count("requests")
+        time.sleep(max(0.0, s.latency + random.uniform(-s.jitter, s.jitter)))
+        roll = random.random()
+        if roll < s.rate_limit_rate:
+            self.server.count("rate_limited")
+            self._send_json(429, {"error": {"code": 429, "message": "Resource has been exhausted (fake).", "status": "RESOURCE_EXHAUSTED", "type": "rate_limit_exceeded"}},
+                            {"Retry-After": f"{s.retry_after:g}"})
+            return True
+        if roll < s.rate_limit_rate + s.error_rate:
+            self.server.count("errors")
+            self._send_json(500, {"error": {"code": 500, "message": "Internal error (fake).", "status": "INTERNAL", "type": "server_error"}})
+            return True
+        return None
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/v1beta/models":
+            models = [{"name": f"models/{m}", "supportedGenerationMethods": ["generateContent", "countTokens"]}
+                      for m in GEMINI_MODELS if m not in self.settings.missing_models]
+            self._send_json(200, {"models": models})
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": f"Unknown path {self.path}", "status": "NOT_FOUND"}})
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        body = self._read_body()
+        if path.endswith("/chat/completions"):
+            self._openai(body)
+            return
+        if path == "/v1beta/cachedContents":
+            self._create_cache(body)
+            return
+        match = _GEMINI_PATH.match(path)
+        if match:
+            self._gemini(match.group(1), match.group(2) == "streamGenerateContent", body)
+            return
+        self._send_json(404, {"error": {"code": 404, "message": f"Unknown path {self.path}", "status": "NOT_FOUND"}})
+
+    def do_DELETE(self):
+        path = self.path.split("?")[0]
+        if path.startswith("/v1beta/cachedContents/") and self.server.delete_cache(path[len("/v1beta/"):]):
+            self._send_json(200, {})
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": f"Unknown path {self.path}", "status": "NOT_FOUND"}})
+
+    def _openai(self, body):
+        if self._simulate():
+            return
+        s = self.settings
+        model = body.get("model", "fake")
+        if model in s.schemaless_models and (body.get("response_format") or {}).get("type") == "json_schema":
+            self._send_json(400, {"error": {"message": f"Invalid response_format: json_schema is not supported by {model} (fake).",
+                                            "type": "invalid_request_error", "param": "response_format", "code": None}})
+            return
+        content = make_content(s.tags, request_text(body), s.max_variants)
+        created = int(time.time())
+        prompt_tokens = count_tokens(request_text(body))
+        cached = self.server.prefix_cached(system_text(body))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": count_tokens(content), "total_tokens": prompt_tokens + count_tokens(content),
+                 "prompt_tokens_details": {"cached_tokens": cached}}
+        if not body.get("stream"):
+            self._send_json(200, {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+        self._start_chunked("text/event-stream")
+        for piece in split_text(content, s.stream_chunks):
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+            time.sleep(s.chunk_delay)
+        final = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        self._write_chunk(f"data: {json.dumps(final)}\n\n")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            usage_chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model, "choices": [], "usage": usage}
+            self._write_chunk(f"data: {json.dumps(usage_chunk)}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self._end_chunked()
+
+    def _gemini(self, model, stream, body):
+        s = self.settings
+        if model in s.missing_models:
+            self.server.count("requests")
+            self._send_json(404, {"error": {"code": 404, "message": f"models/{model} is not found (fake).", "status": "NOT_FOUND"}})
+            return
+        prefix = None
+        if body.get("cachedContent"):
+            prefix = self.server.caches.get(body["cachedContent"])
+            if prefix is None:
+                self.server.count("requests")
+                self._send_json(403, {"error": {"code": 403, "message": "CachedContent not found (or permission denied) (fake).", "status": "PERMISSION_DENIED"}})
+                return
+        if self._simulate():
+            return
+        content = make_content(s.tags, request_text(body), s.max_variants)
+        if prefix is not None:
+            cached = count_tokens(prefix)
+            prompt_tokens = cached + count_tokens(request_text(body))
+        else:
+            cached = self.server.prefix_cached(system_text(body))
+            prompt_tokens = count_tokens(request_text(body))
+
+        def candidate(text, finished):
+            item = {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}]}
+            if finished:
+                item["candidates"][0]["finishReason"] = "STOP"
+                item["usageMetadata"] = {"promptTokenCount": prompt_tokens, "cachedContentTokenCount": cached,
+                                         "candidatesTokenCount": count_tokens(content), "totalTokenCount": prompt_tokens + count_tokens(content)}
+            return item
+
+        if not stream:
+            self._send_json(200, candidate(content, True))
+            return
+        # The REST transport reads a JSON array whose elements arrive one by one
+        self._start_chunked("application/json; charset=utf-8")
+        pieces = split_text(content, s.stream_chunks)
+        for i, piece in enumerate(pieces):
+            prefix = "[" if i == 0 else ",\r\n"
+            self._write_chunk(prefix + json.dumps(candidate(piece, i == len(pieces) - 1), ensure_ascii=False))
+            time.sleep(s.chunk_delay)
+        self._write_chunk("]")
+        self._end_chunked()
+
+    def _create_cache(self, body):
+        self.server.count("cache_creates")
+        prefix = _content_text(body.get("systemInstruction"))
+        tokens = count_tokens(prefix)
+        if tokens < self.settings.min_cache_tokens:
+            self._send_json(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                                            "message": f"Cached content is too small. total_token_count={tokens}, min_total_token_count={self.settings.min_cache_tokens} (fake)."}})
+            return
+        name = self.server.add_cache(prefix)
+        expires = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 3600))
+        self._send_json(200, {"name": name, "model": body.get("model", ""), "displayName": body.get("displayName", ""),
+                              "expireTime": expires, "usageMetadata": {"totalTokenCount": tokens}})
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, settings=None):
+        super().__init__((host, port), _Handler)
+        self.settings = settings or FakeLLMSettings()
+        self.stats = {"requests": 0, "rate_limited": 0, "errors": 0, "cache_creates": 0, "cache_deletes": 0}
+        self._stats_lock = threading.Lock()
+        self.caches = {} # cachedContents name -> prefix text
+        self._cache_serial = 0
+        self._seen_prefixes = set()
+        self._thread = None
+
+    def handle_error(self, request, client_address):
+        # Cancelled requests drop the connection mid-response; that is expected, not a server error
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    def count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def add_cache(self, prefix):
+        with self._stats_lock:
+            self._cache_serial += 1
+            name = f"cachedContents/fake-{self._cache_serial}"
+            self.caches[name] = prefix
+            return name
+
+    def delete_cache(self, name):
+        with self._stats_lock:
+            if self.caches.pop(name, None) is None:
+                return False
+            self.stats["cache_deletes"] += 1
+            return True
+
+    def prefix_cached(self, prefix):
+        # Cached tokens for an automatically cached prefix: none on first sight or below the minimum size
+        tokens = count_tokens(prefix)
+        if tokens < self.settings.min_cache_tokens:
+            return 0
+        with self._stats_lock:
+            seen = prefix in self._seen_prefixes
+            self._seen_prefixes.add(prefix)
+        return tokens if seen else 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-llm-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def add_settings_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first byte")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=0.1)
+    parser.add_argument("--stream-chunks", type=int, default=8)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--tags", type=int, default=24, help="positive tags per response")
+    parser.add_argument("--missing-models", nargs="*", default=[], help="Gemini models answered with 404")
+    parser.add_argument("--max-variants", type=int, default=0, help="cap on variants per response (0 = none)")
+    parser.add_argument("--min-cache-tokens", type=int, default=1024, help="smallest prompt prefix the prompt caches accept")
+    parser.add_argument("--schemaless-models", nargs="*", default=[], help="OpenAI-compatible models answering json_schema with 400")
+
+def settings_from_args(args):
+    return FakeLLMSettings(args.latency, args.jitter, args.error_rate, args.rate_limit_rate, args.retry_after,
+                           args.stream_chunks, args.chunk_delay, args.tags, args.missing_models, args.max_variants, args.min_cache_tokens, args.schemaless_models)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible / Gemini server for offline benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    server = FakeLLMServer(args.host, args.port, settings_from_args(args))
+    print(f"Fake LLM server on {server.url}")
+    print(f"  AIPI_OPENAI_BASE_URL={server.url}/v1 AIPI_GROK_BASE_URL={server.url}/v1 AIPI_GEMINI_BASE_URL={server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
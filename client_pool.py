@@ -0,0 +1,99 @@
+import asyncio
+import contextlib
+import hashlib
+import inspect
+import threading
+import time
+from collections import OrderedDict
+
+IDLE_TTL_SECONDS = 10 * 60
+MAX_CLIENTS = 16
+
+def _key_hash(api_key):
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+def _close(client):
+    # SDK clients differ in how they release their connections
+    for closer in ("close", "transport.close"):
+        target = client
+        try:
+            for attr in closer.split("."):
+                target = getattr(target, attr)
+            result = target()
+            if inspect.isawaitable(result):
+                # Async clients close on their own event loop; without one the connections just drop with the client
+                try:
+                    asyncio.get_running_loop().create_task(result)
+                except RuntimeError:
+                    result.close()
+            return
+        except Exception:
+            continue
+
+class _Entry:
+    __slots__ = ("client", "last_used", "refs")
+
+    def __init__(self, client):
+        self.client = client
+        self.last_used = 0.0
+        self.refs = 0 # Leases not yet returned; a client in use is never closed
+
+class ClientPool:
+    def __init__(self, idle_ttl=IDLE_TTL_SECONDS, max_clients=MAX_CLIENTS):
+        self.idle_ttl = idle_ttl
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def lease(self, provider, api_key, factory, base_url=None, variant=None):
+        # factory(api_key, base_url) builds the client on first use; later leases reuse it
+        # so that keep-alive connections and TLS sessions survive across requests.
+        # variant separates clients of the same key, e.g. async clients per event loop.
+        # The client stays open until the with block ends, however the pool changes meanwhile.
+        key = (provider, _key_hash(api_key), base_url, variant)
+        with self._lock:
+            self._evict_idle()
+            entry = self._clients.get(key)
+            if entry is not None:
+                self._check_out(key, entry)
+        if entry is None:
+            # Building a client (TLS context, gRPC channel) is slow; other providers' leases must not wait on it
+            client = factory(api_key, base_url)
+            with self._lock:
+                entry = self._clients.get(key)
+                if entry is None:
+                    entry = self._clients[key] = _Entry(client)
+                    client = None
+                self._check_out(key, entry)
+            if client is not None:
+                # Another lease built the same client first
+                _close(client)
+        try:
+            yield entry.client
+        finally:
+            with self._lock:
+                entry.refs -= 1
+                entry.last_used = time.time()
+
+    def _check_out(self, key, entry):
+        # Caller must hold the lock
+        entry.refs += 1
+        entry.last_used = time.time()
+        self._clients.move_to_end(key)
+        self._evict_over_limit()
+
+    def _evict_over_limit(self):
+        # Caller must hold the lock. Least recently used idle clients go first; while every client
+        # is in use the pool may exceed max_clients until some are returned.
+        excess = len(self._clients) - self.max_clients
+        for key in [k for k, e in self._clients.items() if e.refs == 0][:max(0, excess)]:
+            _close(self._clients.pop(key).client)
+
+    def _evict_idle(self):
+        # Caller must hold the lock
+        now = time.time()
+        for key in [k for k, e in self._clients.items() if e.refs == 0 and now - e.last_used > self.idle_ttl]:
+            _close(self._clients.pop(key).client)
+
+client_pool = ClientPool()
@@ -0,0 +1,117 @@
+import atexit
+import copy
+import json
+import os
+import threading
+
+# Writes are coalesced for this long; typing in a textbox touches the disk once per pause, not per key
+SAVE_DELAY_SECONDS = 1.0
+
+class JsonStore:
+    # Parsed JSON file kept in memory. The file is only re-read when its mtime changes
+    # (edited by hand or by another process), and writes go through a temp file + rename.
+    def __init__(self, path, save_delay=SAVE_DELAY_SECONDS):
+        self.path = path
+        self.save_delay = save_delay
+        self._data = None
+        self._mtime = None
+        self._pending = {} # Top-level keys changed since the last write
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _refresh(self):
+        # Caller must hold the lock
+        mtime = self._file_mtime()
+        if self._data is not None and mtime == self._mtime:
+            return
+        data = {}
+        if mtime is not None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f) or {}
+            except Exception as e:
+                print(f"[AIPI] Error loading JSON from {self.path}: {e}")
+                if self._data is not None:
+                    # Half-written by someone else; keep what we have and retry next time
+                    return
+        # Unsaved changes from this process win over the file
+        data.update(copy.deepcopy(self._pending))
+        self._data = data
+        self._mtime = mtime
+
+    def _write(self):
+        # Caller must hold the lock
+        self._refresh()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._data, f, indent=4, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._mtime = self._file_mtime()
+            self._pending = {}
+        except Exception as e:
+            print(f"[AIPI] Error saving JSON to {self.path}: {e}")
+
+    def _schedule(self):
+        # Caller must hold the lock
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(self.save_delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def get(self):
+        # Returns a copy that callers may modify freely
+        with self._lock:
+            self._refresh()
+            return copy.deepcopy(self._data)
+
+    def update(self, values, delay=True):
+        # Merges top-level keys; returns the previous values of the keys that actually changed
+        with self._lock:
+            self._refresh()
+            previous = {}
+            for key, value in values.items():
+                if self._data.get(key) != value:
+                    previous[key] = self._data.get(key)
+                    self._data[key] = copy.deepcopy(value)
+                    self._pending[key] = copy.deepcopy(value)
+            if not previous:
+                return previous
+            if delay:
+                self._schedule()
+            else:
+                self.flush()
+            return previous
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._pending:
+                self._write()
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(path):
+    # One store per file, shared by every session
+    path = os.path.abspath(path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = JsonStore(path)
+        return store
+
+@atexit.register
+def flush_all():
+    for store in list(_stores.values()):
+        store.flush()
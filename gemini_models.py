@@ -0,0 +1,101 @@
+import hashlib
+import threading
+import time
+
+# How long a model listing is trusted before it is refreshed in the background
+LIST_TTL_SECONDS = 60 * 60
+# How long a failed model is skipped, by failure kind
+NOT_FOUND_TTL_SECONDS = 24 * 60 * 60
+RATE_LIMIT_TTL_SECONDS = 60
+# How long to wait for the first listing of a key once all known models have failed
+LIST_WAIT_SECONDS = 15
+
+def key_hash(api_key):
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+class GeminiModelResolver:
+    def __init__(self, list_fn):
+        # list_fn(api_key) -> list of model names supporting generateContent
+        self.list_fn = list_fn
+        self._lock = threading.Lock()
+        self._listings = {}
+        self._refreshing = {}
+        self._last_good = {}
+        self._failed = {}
+
+    def _refresh(self, api_key, kh):
+        try:
+            models = [m.replace('models/', '') for m in self.list_fn(api_key)]
+            with self._lock:
+                self._listings[kh] = (time.time(), models)
+        except Exception as e:
+            print(f"[AIPI] Gemini model listing failed: {e}")
+        finally:
+            with self._lock:
+                event = self._refreshing.pop(kh, None)
+            if event:
+                event.set()
+
+    def _start_refresh(self, api_key, kh):
+        # Caller must hold the lock
+        event = self._refreshing.get(kh)
+        if event is None:
+            event = threading.Event()
+            self._refreshing[kh] = event
+            threading.Thread(target=self._refresh, args=(api_key, kh), daemon=True).start()
+        return event
+
+    def _listed_models(self, api_key, kh, wait):
+        with self._lock:
+            listing = self._listings.get(kh)
+            if listing is None or time.time() - listing[0] > LIST_TTL_SECONDS:
+                event = self._start_refresh(api_key, kh)
+            else:
+                event = None
+        if listing is None and wait and event is not None:
+            event.wait(LIST_WAIT_SECONDS)
+            with self._lock:
+                listing = self._listings.get(kh)
+        return listing[1] if listing else []
+
+    def is_healthy(self, api_key, model_name):
+        until = self._failed.get((key_hash(api_key), model_name))
+        return until is None or until < time.time()
+
+    def candidates(self, api_key, preferred_models, default_models, model_preference=None):
+        kh = key_hash(api_key)
+        seen = set()
+
+        def fresh(names):
+            for name in names:
+                if name in seen or not self.is_healthy(api_key, name):
+                    continue
+                seen.add(name)
+                yield name
+
+        # Hot path: the last model that worked for this preference, then the static lists.
+        # The listing is only consulted without blocking here, and refreshed in the background.
+        last_good = self._last_good.get((kh, model_preference))
+        static = ([last_good] if last_good else []) + list(preferred_models) + list(default_models)
+        yield from fresh(static)
+        yield from fresh(self._listed_models(api_key, kh, wait=False))
+        # Everything known has failed; block on the first listing for this key if it is still running
+        yield from fresh(self._listed_models(api_key, kh, wait=True))
+
+    def record_success(self, api_key, model_name, model_preference=None):
+        kh = key_hash(api_key)
+        with self._lock:
+            self._last_good[(kh, model_preference)] = model_name
+            self._failed.pop((kh, model_name), None)
+
+    def record_failure(self, api_key, model_name, error):
+        if "404" in error:
+            ttl = NOT_FOUND_TTL_SECONDS
+        elif "429" in error:
+            ttl = RATE_LIMIT_TTL_SECONDS
+        else:
+            return
+        kh = key_hash(api_key)
+        with self._lock:
+            self._failed[(kh, model_name)] = time.time() + ttl
+            self._last_good = {k: m for k, m in self._last_good.items() if not (k[0] == kh and m == model_name)}
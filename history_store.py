@@ -0,0 +1,233 @@
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+history_path = os.path.join(base_dir, "history.sqlite3")
+
+# Character n-grams of the index; bigrams suit short Japanese requests
+GRAM_SIZE = 2
+# When the n-grams of a request are common in the history, near duplicates are found by locality-sensitive hashing:
+# the minimum n-gram hash of each of BANDS * BAND_WIDTH slots, grouped into bands. Texts sharing most n-grams very
+# likely share a whole band.
+BANDS = 4
+BAND_WIDTH = 5
+# Candidates scored per lookup, which bounds its cost however large the history grows
+MAX_CANDIDATES = 32
+_HASH_MASK = (1 << 61) - 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    user_input TEXT NOT NULL,
+    normalized TEXT NOT NULL,
+    settings_key TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    result TEXT NOT NULL
+);
+"""
+
+def normalize(text):
+    # Width, case, spacing and punctuation differences do not make a different request
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return "".join(c for c in text if unicodedata.category(c)[0] not in "PZC")
+
+def grams(normalized):
+    if len(normalized) <= GRAM_SIZE:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + GRAM_SIZE] for i in range(len(normalized) - GRAM_SIZE + 1)}
+
+def band_keys(gram_set):
+    # str hashes differ between processes, which is fine for an index rebuilt on every start
+    slots = BANDS * BAND_WIDTH
+    mins = [_HASH_MASK] * slots
+    for gram in gram_set:
+        h = hash(gram) & _HASH_MASK
+        slot = h % slots
+        if h < mins[slot]:
+            mins[slot] = h
+    return [hash((band, *mins[band * BAND_WIDTH:(band + 1) * BAND_WIDTH])) for band in range(BANDS)]
+
+def make_settings_key(llm_type, quality_tags, variants=1):
+    # The settings that change what the model returns; post-processing is re-applied on reuse
+    return json.dumps([llm_type, normalize(quality_tags), int(variants or 1)], ensure_ascii=False)
+
+class HistoryStore:
+    # Every generated result, kept in SQLite. Lookups go through an in-memory index built once from the table:
+    # normalized text -> newest entry for exact repeats, n-gram bands for near duplicates and n-gram postings for search.
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._entries = 0
+        self._exact = {} # (normalized, settings key) -> newest id
+        self._latest = {} # normalized -> newest id
+        self._texts = [] # text number -> normalized; every distinct text is indexed once
+        self._text_numbers = {} # normalized -> text number
+        self._postings = {} # gram -> array of text numbers
+        self._buckets = {} # band key -> text number, or an array of them once shared
+
+    def _connect(self):
+        # Caller must hold the lock
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL") # Durable across crashes of the process, not of the OS
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _load(self):
+        # Caller must hold the lock
+        if self._loaded:
+            return
+        try:
+            for entry_id, normalized, settings_key in self._connect().execute("SELECT id, normalized, settings_key FROM history ORDER BY id"):
+                self._index(entry_id, normalized, settings_key)
+        except Exception as e:
+            print(f"[AIPI] Error loading history from {self.path}: {e}")
+        self._loaded = True
+
+    def _index(self, entry_id, normalized, settings_key):
+        # Caller must hold the lock
+        self._entries += 1
+        self._exact[(normalized, settings_key)] = entry_id
+        self._latest[normalized] = entry_id
+        if normalized in self._text_numbers:
+            return
+        number = len(self._texts)
+        self._texts.append(normalized)
+        self._text_numbers[normalized] = number
+        gram_set = grams(normalized)
+        for gram in gram_set:
+            postings = self._postings.get(gram)
+            if postings is None:
+                postings = self._postings[gram] = array("i")
+            postings.append(number)
+        # Most bands belong to a single text, so they hold a plain int until a second one arrives
+        for key in band_keys(gram_set):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._buckets[key] = number
+            elif type(bucket) is int:
+                self._buckets[key] = array("i", (bucket, number))
+            else:
+                bucket.append(number)
+
+    def warm(self):
+        # Builds the index ahead of the first lookup (it takes a moment on a large history)
+        with self._lock:
+            self._load()
+
+    def add(self, user_input, settings, result, settings_key):
+        # Id of the new entry, or None when it could not be written
+        normalized = normalize(user_input)
+        with self._lock:
+            self._load()
+            try:
+                db = self._connect()
+                cursor = db.execute(
+                    "INSERT INTO history (created, user_input, normalized, settings_key, settings, result) VALUES (?, ?, ?, ?, ?, ?)",
+                    (time.time(), user_input, normalized, settings_key, json.dumps(settings, ensure_ascii=False), json.dumps(result, ensure_ascii=False)),
+                )
+                db.commit()
+            except Exception as e:
+                print(f"[AIPI] Error saving history to {self.path}: {e}")
+                return None
+            self._index(cursor.lastrowid, normalized, settings_key)
+            return cursor.lastrowid
+
+    def find(self, user_input, settings_key):
+        # Newest entry for the same request (after normalization) and settings, or None
+        with self._lock:
+            self._load()
+            entry_id = self._exact.get((normalize(user_input), settings_key))
+        return self.get(entry_id) if entry_id is not None else None
+
+    def similar(self, text, limit=5, min_score=0.7):
+        # [(score, newest id)] of near duplicates of a request, e.g. to offer their results before calling the LLM.
+        # Scored by the Dice coefficient of the n-gram sets.
+        query = grams(normalize(text))
+        if not query:
+            return []
+        # Prefix filtering: a text reaching min_score shares at least `needed` n-grams with the query, so it
+        # contains one of the len(query) - needed + 1 rarest ones
+        needed = min(len(query), max(1, math.ceil(min_score * len(query) / (2 - min_score))))
+        with self._lock:
+            self._load()
+            prefix = sorted((self._postings.get(g, ()) for g in query), key=len)[:len(query) - needed + 1]
+            if sum(map(len, prefix)) <= MAX_CANDIDATES:
+                # Rare enough to score every text that can match
+                candidates = set().union(*prefix)
+            else:
+                candidates = set()
+                buckets = [self._buckets[key] for key in band_keys(query) if key in self._buckets]
+                # Smallest buckets first: a band shared by few texts says more than one shared by many
+                for bucket in sorted(((b,) if type(b) is int else b for b in buckets), key=len):
+                    room = MAX_CANDIDATES - len(candidates)
+                    if room <= 0:
+                        break
+                    candidates.update(bucket[-room:]) # Newest texts of a crowded bucket
+            matches = []
+            for number in candidates:
+                normalized = self._texts[number]
+                other = grams(normalized)
+                score = 2 * len(query & other) / (len(query) + len(other))
+                if score >= min_score:
+                    matches.append((score, self._latest[normalized]))
+        # Best first, newer first among equals
+        matches.sort(key=lambda m: (-m[0], -m[1]))
+        return matches[:limit]
+
+    def _search(self, query, limit):
+        # Newest ids of the texts containing the normalized query
+        with self._lock:
+            self._load()
+            if len(query) < GRAM_SIZE:
+                candidates = range(len(self._texts))
+            else:
+                # Every match contains each n-gram of the query, so the shortest postings list holds them all
+                candidates = min((self._postings.get(g, ()) for g in grams(query)), key=len)
+            ids = []
+            for number in reversed(candidates):
+                normalized = self._texts[number]
+                if query in normalized:
+                    ids.append(self._latest[normalized])
+                    if len(ids) >= limit:
+                        break
+        return sorted(ids, reverse=True)
+
+    def search(self, query, limit=50):
+        # Entries for the history panel, newest first; the newest entries when query is empty
+        query = normalize(query)
+        if not query:
+            with self._lock:
+                rows = self._connect().execute("SELECT id FROM history ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+            return self.get_many([r[0] for r in rows])
+        return self.get_many(self._search(query, limit))
+
+    def get(self, entry_id):
+        entries = self.get_many([entry_id])
+        return entries[0] if entries else None
+
+    def get_many(self, ids):
+        if not ids:
+            return []
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT id, created, user_input, settings, result FROM history WHERE id IN ({','.join('?' * len(ids))})", list(ids)
+            ).fetchall()
+        by_id = {r[0]: {"id": r[0], "created": r[1], "user_input": r[2], "settings": json.loads(r[3]), "result": json.loads(r[4])} for r in rows}
+        return [by_id[i] for i in ids if i in by_id]
+
+    def stats(self):
+        # Without the lock, so that status lines never wait for warm(); the counts grow while it runs
+        return {"entries": self._entries, "distinct": len(self._texts)}
+
+history_store = HistoryStore(history_path)
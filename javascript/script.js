@@ -1,24 +1,62 @@
+// Same normalization as tag_key in tag_dictionary.py, which renders the data-word attributes
+const AIPI_TAG_WEIGHT = /^[(\[{]+|[)\]}]+$|:\s*-?[\d.]+\s*[)\]}]*$/g;
+function aipiTagKey(tag) {
+    return tag.normalize('NFKC').replace(/_/g, ' ').trim().replace(AIPI_TAG_WEIGHT, '').toLowerCase().split(/\s+/).filter(Boolean).join(' ');
+}
+
+// Tag key -> translation items, and each word of a key -> items, rebuilt when a translation panel is re-rendered
+let aipiMappingIndex = null;
+let aipiHighlighted = [];
+
+function aipiBuildMappingIndex() {
+    const tags = new Map();
+    const words = new Map();
+    const add = (map, key, item) => {
+        const items = map.get(key);
+        if (items) items.push(item);
+        else map.set(key, [item]);
+    };
+    gradioApp().querySelectorAll('.translation-item').forEach(item => {
+        const key = item.dataset.word;
+        if (!key) return;
+        add(tags, key, item);
+        new Set(key.split(' ')).forEach(word => add(words, word, item));
+    });
+    return { tags, words };
+}
 
 function geminiHighlightWord() {
-    const handler = (event) => {
-        const textarea = event.target;
+    let pending = null;
+
+    const update = () => {
+        const textarea = pending;
+        pending = null;
         const start = textarea.selectionStart;
         const end = textarea.selectionEnd;
         const text = textarea.value;
 
         if (start === end) {
+            // The whole tag under the caret, falling back to the word under it
+            const tagStart = text.lastIndexOf(',', start - 1) + 1;
+            const tagEnd = text.indexOf(',', start);
+            const tag = text.substring(tagStart, tagEnd === -1 ? text.length : tagEnd);
             let s = start;
             while (s > 0 && /\w/.test(text[s - 1])) s--;
             let e = start;
             while (e < text.length && /\w/.test(text[e])) e++;
-            const word = text.substring(s, e).trim().toLowerCase();
-            if (word) highlightMapping(word);
+            highlightMapping(aipiTagKey(tag), text.substring(s, e).toLowerCase());
         } else {
-            const selectedText = text.substring(start, end).trim().toLowerCase();
-            if (selectedText) highlightMapping(selectedText);
+            const selectedText = aipiTagKey(text.substring(start, end));
+            highlightMapping(selectedText, selectedText);
         }
     };
 
+    // At most one lookup per frame, however fast keys repeat
+    const handler = (event) => {
+        if (pending === null) requestAnimationFrame(update);
+        pending = event.target;
+    };
+
     // Use delegation for dynamic elements in new tab
     document.addEventListener('click', (e) => {
         if (e.target.tagName === 'TEXTAREA' && (e.target.closest('#gemini_pos_prompt') || e.target.closest('#gemini_neg_prompt'))) {
@@ -30,30 +68,72 @@ function geminiHighlightWord() {
             handler(e);
         }
     });
+
+    // Gradio replaces the panels' HTML on every Generate; the index is rebuilt on the next lookup
+    const observer = new MutationObserver(() => { aipiMappingIndex = null; aipiHighlighted = []; });
+    ['#gemini_pos_translation_display', '#gemini_neg_translation_display'].forEach(selector => {
+        const panel = gradioApp().querySelector(selector);
+        if (panel) observer.observe(panel, { childList: true, subtree: true });
+    });
 }
 
-function highlightMapping(word) {
-    const items = document.querySelectorAll('.translation-item');
-    let found = false;
-    items.forEach(item => {
-        const targetWord = item.getAttribute('data-word').toLowerCase();
-        if (targetWord === word || word.includes(targetWord) || targetWord.includes(word)) {
-            item.style.backgroundColor = '#ffff0033';
-            item.style.fontWeight = 'bold';
-            if (!found) {
-                item.scrollIntoView({ behavior: 'smooth', block: 'nearest' });
-                found = true;
-            }
-        } else {
-            item.style.backgroundColor = 'transparent';
-            item.style.fontWeight = 'normal';
+function highlightMapping(tag, word) {
+    if (aipiMappingIndex === null) aipiMappingIndex = aipiBuildMappingIndex();
+    const items = aipiMappingIndex.tags.get(tag) || (word && aipiMappingIndex.words.get(word)) || [];
+    aipiHighlighted.forEach(item => item.classList.remove('aipi_highlight'));
+    items.forEach(item => item.classList.add('aipi_highlight'));
+    aipiHighlighted = items;
+    if (items.length) items[0].scrollIntoView({ behavior: 'smooth', block: 'nearest' });
+}
+
+function aipiSetPrompts(tab, pos, neg) {
+    const posTarget = gradioApp().querySelector(`#${tab}_prompt textarea`);
+    const negTarget = gradioApp().querySelector(`#${tab}_neg_prompt textarea`);
+    [[posTarget, pos], [negTarget, neg]].forEach(([target, value]) => {
+        if (target && value !== undefined) {
+            target.value = value;
+            target.dispatchEvent(new Event('input', { bubbles: true }));
         }
     });
 }
 
+function aipiShowTab(tab) {
+    const tabButton = Array.from(gradioApp().querySelectorAll('#tabs button')).find(b => b.innerText.toLowerCase() === tab);
+    if (tabButton) tabButton.click();
+}
+
+// Quoting understood by shlex.split, which the "Prompts from file or textbox" script uses per line
+function aipiShellQuote(value) {
+    return "'" + value.replace(/'/g, "'\"'\"'") + "'";
+}
+
+function aipiSendVariants(rows) {
+    if (!rows.length) return;
+    const tab = 'txt2img';
+    // The first variant goes into the prompt fields as well, so a plain Generate also works
+    aipiSetPrompts(tab, rows[0].dataset.positive, rows[0].dataset.negative);
+    const lines = rows.map(row => `--prompt ${aipiShellQuote(row.dataset.positive)} --negative_prompt ${aipiShellQuote(row.dataset.negative)}`).join('\n');
+    const scriptInput = gradioApp().querySelector(`#script_${tab}_prompts_from_file_or_textbox_prompt_txt textarea`);
+    if (scriptInput) {
+        scriptInput.value = lines;
+        scriptInput.dispatchEvent(new Event('input', { bubbles: true }));
+    } else {
+        navigator.clipboard?.writeText(lines);
+        alert('「Prompts from file or textbox」の入力欄が見つからないため、クリップボードにコピーしました。');
+    }
+    aipiShowTab(tab);
+}
+
 onUiLoaded(() => {
     geminiHighlightWord();
 
+    // Variant rows are re-rendered on every Generate, so their controls use delegation
+    document.addEventListener('change', (e) => {
+        if (e.target.classList?.contains('aipi_variant_select_all')) {
+            e.target.closest('.aipi_variants').querySelectorAll('.aipi_variant_select').forEach(box => { box.checked = e.target.checked; });
+        }
+    });
+
     // ADetailer-style: Move checkbox into accordion header
     const setupAccordionCheckbox = () => {
         const checkbox = gradioApp().querySelector('#aipi_prompt_settings_checkbox');
@@ -149,6 +229,20 @@ onUiLoaded(() => {
             }
         };
 
+        const variantSend = target.closest('.aipi_variant_send');
+        if (variantSend) {
+            const row = variantSend.closest('.aipi_variant');
+            aipiSetPrompts('txt2img', row.dataset.positive, row.dataset.negative);
+            aipiShowTab('txt2img');
+            return;
+        }
+        const variantsSendAll = target.closest('.aipi_variants_send_all');
+        if (variantsSendAll) {
+            const rows = Array.from(variantsSendAll.closest('.aipi_variants').querySelectorAll('.aipi_variant')).filter(row => row.querySelector('.aipi_variant_select')?.checked);
+            aipiSendVariants(rows);
+            return;
+        }
+
         if (target.id === 'gemini_pos_send' || target.closest('#gemini_pos_send')) {
             transferToSD('#gemini_pos_prompt', '_prompt');
         }
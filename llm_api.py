@@ -1,136 +1,493 @@
-import google.generativeai as genai
-import openai
-import json
-import re
-
-def generate_prompts_gemini(api_key, user_input, model_preference=None, **kwargs):
-    if not api_key:
-        return None, "Gemini API Key is required."
-    
-    genai.configure(api_key=api_key)
-    
-    # Define model lists for different preferences
-    model_lists = {
-        "Gemini 3.0": ['gemini-3.0-pro', 'gemini-3.0-flash'],
-        "Gemini 2.0": ['gemini-2.0-flash', 'gemini-2.0-flash-exp'],
-        "Gemini 1.5": ['gemini-1.5-flash', 'gemini-1.5-pro']
-    }
-    
-    models_to_try = []
-    if model_preference in model_lists:
-        models_to_try.extend(model_lists[model_preference])
-    
-    # Add defaults if not already present
-    default_models = ['gemini-1.5-flash', 'gemini-2.0-flash', 'gemini-1.5-pro']
-    for m in default_models:
-        if m not in models_to_try:
-            models_to_try.append(m)
-    
-    # Also fetch all available models to be super robust
-    try:
-        available_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-        for m in available_models:
-            clean_name = m.replace('models/', '')
-            if clean_name not in models_to_try:
-                models_to_try.append(clean_name)
-    except Exception:
-        pass # Fallback to hardcoded if listing fails
-    
+import asyncio
+import copy
+import time
+import metrics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from response_cache import response_cache, make_key
+from partial_json import PartialJsonFields
+from router import model_router
+from rate_limit import make_deadline
+from singleflight import SingleFlight, SessionRequests, AsyncSingleFlight, AsyncSessionRequests, SUPERSEDED_ERROR
+from request_queue import AsyncRequestQueue
+from prompt_builder import parse_json_response, PARSE_ERROR_PREFIX, SYSTEM_PROMPT_VERSION
+from llm_providers import provider_for_llm_type, providers
+from llm_providers.common import run_blocking, usage_stats
+from tag_dictionary import tag_dictionary
+from tag_pipeline import tokenize
+
+# Lets the router pick the provider and model from observed latency and error rates
+AUTO_LLM = "Auto"
+
+# Generates running at once from the UI; further clicks wait in line and see their position
+MAX_CONCURRENT_GENERATES = 4
+
+flights = SingleFlight()
+session_requests = SessionRequests()
+async_flights = AsyncSingleFlight()
+async_session_requests = AsyncSessionRequests()
+generate_queue = AsyncRequestQueue(MAX_CONCURRENT_GENERATES)
+
+# Variants asked for in one structured response unless the provider sets max_variants_per_call;
+# larger counts are split into parallel calls
+MAX_VARIANTS_PER_CALL = 4
+MAX_VARIANTS = 8
+
+# Shared by race mode; losers keep running here after the winner has returned
+_race_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="aipi-race")
+
+def provider_for(llm_type):
+    return provider_for_llm_type(llm_type).name
+
+def auto_candidates(api_keys):
+    # (llm_type, provider, model) for every model the configured keys can reach
+    candidates = []
+    for provider in providers():
+        api_key = api_keys.get(provider.name)
+        if api_key:
+            candidates.extend((provider.llm_type, provider.name, m) for m in provider.auto_models(api_key))
+    return candidates
+
+def _resolve_auto(llm_type, api_key, api_keys, kwargs):
+    # Returns (llm_type, api_key, error); the chosen model is passed on through kwargs
+    if llm_type != AUTO_LLM:
+        return llm_type, api_key, None
+    choice = model_router.choose(auto_candidates(api_keys or {}))
+    if choice is None:
+        return None, None, "Auto: No API key is configured."
+    llm_type, provider, kwargs["model"] = choice
+    return llm_type, api_keys[provider], None
+
+def resolve_auto(llm_type, api_key, api_keys):
+    # (llm_type, api_key, model, error) with Auto replaced by the router's current choice, for callers that
+    # send many requests to one model (model is None when llm_type is not Auto)
+    kwargs = {}
+    llm_type, api_key, error = _resolve_auto(llm_type, api_key, api_keys, kwargs)
+    return llm_type, api_key, kwargs.get("model"), error
+
+def resolve_model(llm_type):
+    return provider_for_llm_type(llm_type).resolve_model(llm_type)
+
+def _dispatch(llm_type, api_key, user_input, **kwargs):
+    return provider_for_llm_type(llm_type).generate(api_key, user_input, model_preference=llm_type, **kwargs)
+
+def _dispatch_stream(llm_type, api_key, user_input, **kwargs):
+    return provider_for_llm_type(llm_type).stream(api_key, user_input, model_preference=llm_type, **kwargs)
+
+def _race(candidates, user_input, hedge_delay=0.0, max_extra=1, **kwargs):
+    # Launch the first candidate, then hedge with the next one every hedge_delay seconds
+    # (all at once when hedge_delay is 0). At most max_extra additional requests are ever sent.
+    queue = list(candidates)[:1 + max(0, int(max_extra))]
+    pending = {}
     last_error = None
-    for model_name in models_to_try:
-        try:
-            model = genai.GenerativeModel(model_name)
-            
-            prompt = create_system_prompt(user_input, kwargs.get("quality_tags"))
-            response = model.generate_content(prompt)
-            
-            return parse_json_response(response.text, model_name)
-                
-        except Exception as e:
-            last_error = str(e)
-            if "404" in last_error or "429" in last_error:
-                continue
+
+    def launch():
+        llm_type, api_key = queue.pop(0)
+        pending[_race_executor.submit(_dispatch, llm_type, api_key, user_input, **kwargs)] = llm_type
+
+    launch()
+    while queue and hedge_delay <= 0:
+        launch()
+
+    while pending:
+        done, _ = wait(pending, timeout=(hedge_delay if queue else None), return_when=FIRST_COMPLETED)
+        if not done:
+            launch()
+            continue
+        for future in done:
+            llm_type = pending.pop(future)
+            try:
+                data, error = future.result()
+            except Exception as e:
+                data, error = None, str(e)
+            if not error and data:
+                # Requests that have not started yet are dropped; running ones are ignored
+                for loser in pending:
+                    loser.cancel()
+                return data, None, llm_type
+            last_error = f"{llm_type}: {error}"
+            # A fast failure should not wait out the hedging delay
+            if queue:
+                launch()
+
+    return None, f"All raced providers failed. Last error: {last_error}", None
+
+def _cache_key(llm_type, user_input, kwargs):
+    variants = kwargs.get("variants", 1), kwargs.get("variant_batch", 0)
+    return make_key(llm_type, kwargs.get("model") or resolve_model(llm_type), user_input, kwargs.get("quality_tags"), SYSTEM_PROMPT_VERSION,
+                    variants if variants != (1, 0) else None)
+
+def _prepare(llm_type, api_key, api_keys, kwargs):
+    # Prologue of every entry point: request deadline, known tags for the prompt, Auto resolved to a provider.
+    # Returns (llm_type, api_key, error)
+    kwargs.setdefault("deadline", make_deadline())
+    kwargs.setdefault("known_tags", tag_dictionary.prompt_tags())
+    return _resolve_auto(llm_type, api_key, api_keys, kwargs)
+
+def _cached(cache_keys):
+    # The first cached response among cache_keys, or None. May read the disk; async callers run it in a worker thread.
+    with metrics.span("cache_lookup"):
+        for key in cache_keys:
+            cached = response_cache.get(key)
+            if cached is not None:
+                metrics.count("cache_hits")
+                return cached
+    metrics.count("cache_misses")
+    return None
+
+def _remember(cache_key, data, model):
+    # Refresh the cache on success even when the lookup was bypassed. The tag dictionary may save to disk,
+    # so async callers run this in a worker thread too.
+    with metrics.span("tag_dictionary"):
+        tag_dictionary.complete(data)
+    response_cache.put(cache_key, data, model=model)
+
+class _StreamCollector:
+    # Turns provider stream events into partial fields and the final parsed result;
+    # shared by the sync and async stream entry points
+    def __init__(self, llm_type):
+        self.llm_type = llm_type
+        self.fields = PartialJsonFields(("positive", "negative"))
+        self.text_parts = []
+        self.started = time.perf_counter()
+        self.first_token = True
+
+    def text(self, value):
+        # True when positive or negative grew
+        if self.first_token:
+            metrics.observe("first_token", time.perf_counter() - self.started)
+            self.first_token = False
+        self.text_parts.append(value)
+        return self.fields.feed(value)
+
+    def partial(self):
+        return dict(self.fields.values)
+
+    def done(self, value):
+        model_name, latency = value
+        metrics.observe("llm_call", time.perf_counter() - self.started)
+        with metrics.span("parse"):
+            data, error = parse_json_response("".join(self.text_parts), model_name)
+        model_router.record(provider_for(self.llm_type), model_name, latency, "parse_error" if error else "ok")
+        return data, error
+
+def generate_prompts(llm_type, api_key, user_input, use_cache=True, race_with=None, hedge_delay=0.0, max_extra=1, api_keys=None, session_id=None, cancel_event=None, **kwargs):
+    # race_with: optional list of (llm_type, api_key) raced against the primary provider
+    # api_keys: {"gemini": ..., "openai": ..., "grok": ...}, only needed for llm_type "Auto"
+    # session_id: when given, a newer request from the same session supersedes this one
+    # cancel_event: stops waiting when set, like being superseded (used when session_id is not given)
+    llm_type, api_key, error = _prepare(llm_type, api_key, api_keys, kwargs)
+    if error:
+        return None, error
+    candidates = [(llm_type, api_key)] + [c for c in (race_with or []) if c[0] != llm_type and c[1]]
+    if len(candidates) > 1:
+        # Raced providers use their own default models
+        kwargs.pop("model", None)
+    cache_keys = {t: _cache_key(t, user_input, kwargs) for t, _ in candidates}
+    if use_cache:
+        cached = _cached(cache_keys[t] for t, _ in candidates)
+        if cached is not None:
+            return cached, None
+
+    def run(flight_cancelled):
+        call_kwargs = dict(kwargs, cancel_event=flight_cancelled)
+        with metrics.span("llm_call"):
+            if len(candidates) > 1:
+                data, error, winner = _race(candidates, user_input, hedge_delay, max_extra, **call_kwargs)
             else:
-                return None, f"Error with {model_name}: {last_error}"
-    
-    return None, f"All Gemini models ({len(models_to_try)}) failed. Please try ChatGPT instead. Last error: {last_error}"
-
-def generate_prompts_openai(api_key, user_input, **kwargs):
-    if not api_key:
-        return None, "OpenAI API Key is required."
-    
-    client = openai.OpenAI(api_key=api_key)
-    
+                data, error = _dispatch(llm_type, api_key, user_input, **call_kwargs)
+                winner = llm_type
+
+        if not error and data:
+            _remember(cache_keys[winner], data, kwargs.get("model") or resolve_model(winner))
+        return data, error
+
+    # Identical requests already in flight are joined instead of paying for another call
+    session_event = session_requests.start(session_id) if session_id else cancel_event
+    try:
+        result = flights.do(tuple(cache_keys[t] for t, _ in candidates), run, session_event)
+    finally:
+        if session_id:
+            session_requests.finish(session_id, session_event)
+    if result is None:
+        return None, SUPERSEDED_ERROR
+    data, error = result
+    # Every caller of a shared flight gets its own copy
+    return copy.deepcopy(data), error
+
+def generate_prompts_stream(llm_type, api_key, user_input, use_cache=True, api_keys=None, session_id=None, **kwargs):
+    # Yields ("partial", {"positive": ..., "negative": ...}) as tokens arrive, then ("result", (data, error))
+    llm_type, api_key, error = _prepare(llm_type, api_key, api_keys, kwargs)
+    if error:
+        yield "result", (None, error)
+        return
+    cache_key = _cache_key(llm_type, user_input, kwargs)
+    if use_cache:
+        cached = _cached([cache_key])
+        if cached is not None:
+            yield "result", (cached, None)
+            return
+
+    session_event = session_requests.start(session_id) if session_id else None
+    flight, leader = flights.join((cache_key,))
+    if not leader:
+        # Someone is already generating this; wait for their final result instead of streaming a copy
+        try:
+            result = flights.wait(flight, session_event)
+        finally:
+            if session_id:
+                session_requests.finish(session_id, session_event)
+        yield "result", (None, SUPERSEDED_ERROR) if result is None else (copy.deepcopy(result[0]), result[1])
+        return
+
+    collector = _StreamCollector(llm_type)
+    superseded = False
+    result = (None, "The response stream ended unexpectedly.")
+    stream = _dispatch_stream(llm_type, api_key, user_input, **kwargs)
     try:
-        prompt = create_system_prompt(user_input, kwargs.get("quality_tags"))
-        response = client.chat.completions.create(
-            model="gpt-4o-mini", # Default fast model
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"}
-        )
-        
-        return parse_json_response(response.choices[0].message.content, "gpt-4o-mini")
-        
-    except Exception as e:
-        return None, f"OpenAI Error: {str(e)}"
-
-def generate_prompts_grok(api_key, user_input, **kwargs):
-    if not api_key:
-        return None, "Grok API Key is required."
-    
-    client = openai.OpenAI(
-        api_key=api_key,
-        base_url="https://api.x.ai/v1",
-    )
-    
+        for kind, value in stream:
+            if session_event is not None and session_event.is_set():
+                superseded = True
+                # Keep reading silently if other callers are waiting on this stream
+                if flight.waiters <= 1:
+                    result = (None, SUPERSEDED_ERROR)
+                    break
+            if kind == "text":
+                if collector.text(value) and not superseded:
+                    yield "partial", collector.partial()
+            elif kind == "error":
+                result = (None, value)
+                break
+            else:
+                result = collector.done(value)
+                if not result[1] and result[0]:
+                    _remember(cache_key, result[0], kwargs.get("model") or resolve_model(llm_type))
+                break
+    finally:
+        stream.close()
+        flights.complete((cache_key,), flight, result)
+        flights.leave(flight)
+        if session_id:
+            session_requests.finish(session_id, session_event)
+    yield "result", (None, SUPERSEDED_ERROR) if superseded else result
+
+async def _dispatch_async(llm_type, api_key, user_input, **kwargs):
+    return await provider_for_llm_type(llm_type).generate_async(api_key, user_input, model_preference=llm_type, **kwargs)
+
+def _dispatch_stream_async(llm_type, api_key, user_input, **kwargs):
+    return provider_for_llm_type(llm_type).stream_async(api_key, user_input, model_preference=llm_type, **kwargs)
+
+async def _superseding(session_id, coro):
+    # Runs coro as its own task that a newer request from the same session (or cancel_session) cancels
+    work = asyncio.ensure_future(coro)
+    superseded = False
+
+    def supersede():
+        nonlocal superseded
+        superseded = True
+        work.cancel()
+
+    if session_id:
+        async_session_requests.start(session_id, supersede)
     try:
-        prompt = create_system_prompt(user_input, kwargs.get("quality_tags"))
-        response = client.chat.completions.create(
-            model="grok-beta", # Or another appropriate model name
-            messages=[{"role": "user", "content": prompt}],
-        )
-        
-        return parse_json_response(response.choices[0].message.content, "grok-beta")
-        
-    except Exception as e:
-        return None, f"Grok Error: {str(e)}"
-
-def create_system_prompt(user_input, quality_tags=None):
-    quality_constraint = ""
-    if quality_tags:
-        quality_constraint = f"\nCRITICAL: Do not output any quality tags other than the following: {quality_tags}. Strictly follow this."
-
-    full_request = f"Stable Diffusion で利用するプロンプトを生成してください。\n要望: {user_input}{quality_constraint}"
-    return f"""
-Convert the following request into Stable Diffusion prompts (Positive and Negative).
-Return the result in JSON format with the following keys:
-- positive: The English positive prompt (comma-separated tags). IMPORTANT: Place all quality tags (e.g., masterpiece, best quality, ultra high res, etc.) at the very beginning of this list.
-- negative: The English negative prompt (comma-separated tags).
-- pos_mapping: A list of objects with "word" (English tag from positive) and "translation" (Japanese meaning).
-- neg_mapping: A list of objects with "word" (English tag from negative) and "translation" (Japanese meaning).
-
-Request: {full_request}
-
-Response MUST be ONLY the JSON object.
-"""
-
-def parse_json_response(text, model_name):
+        return await work
+    except asyncio.CancelledError:
+        # Cancelling the caller itself (Gradio's cancel) propagates as usual
+        if superseded:
+            return None, SUPERSEDED_ERROR
+        raise
+    finally:
+        if session_id:
+            async_session_requests.finish(session_id, supersede)
+
+async def generate_prompts_async(llm_type, api_key, user_input, use_cache=True, race_with=None, hedge_delay=0.0, max_extra=1, api_keys=None, session_id=None, **kwargs):
+    # generate_prompts for the event loop: no thread is held while waiting on the provider, and
+    # cancelling the calling task aborts the HTTP request in flight
+    if race_with:
+        # Racing stays on threads; run_blocking makes generate_prompts give up when this task is cancelled
+        return await _superseding(session_id, run_blocking(generate_prompts, llm_type, api_key, user_input, use_cache=use_cache, race_with=race_with, hedge_delay=hedge_delay, max_extra=max_extra, api_keys=api_keys, **kwargs))
+
+    # The known tags may have to be loaded from disk first
+    llm_type, api_key, error = await asyncio.to_thread(_prepare, llm_type, api_key, api_keys, kwargs)
+    if error:
+        return None, error
+    cache_key = _cache_key(llm_type, user_input, kwargs)
+    if use_cache:
+        cached = await asyncio.to_thread(_cached, [cache_key])
+        if cached is not None:
+            return cached, None
+
+    async def run():
+        try:
+            with metrics.span("llm_call"):
+                data, error = await _dispatch_async(llm_type, api_key, user_input, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return None, f"Unexpected error: {e}"
+        if not error and data:
+            await asyncio.to_thread(_remember, cache_key, data, kwargs.get("model") or resolve_model(llm_type))
+        return data, error
+
+    # Identical requests already in flight are joined, as in generate_prompts
+    result = None
+    while result is None:
+        # None: the joined request was a stream whose caller went away before it finished
+        result = await _superseding(session_id, async_flights.do((cache_key,), run))
+    data, error = result
+    return copy.deepcopy(data), error
+
+async def generate_prompts_stream_async(llm_type, api_key, user_input, use_cache=True, api_keys=None, session_id=None, **kwargs):
+    # Async generator with the same events as generate_prompts_stream
+    # The known tags may have to be loaded from disk first
+    llm_type, api_key, error = await asyncio.to_thread(_prepare, llm_type, api_key, api_keys, kwargs)
+    if error:
+        yield "result", (None, error)
+        return
+    cache_key = _cache_key(llm_type, user_input, kwargs)
+    if use_cache:
+        cached = await asyncio.to_thread(_cached, [cache_key])
+        if cached is not None:
+            yield "result", (cached, None)
+            return
+
+    while True:
+        flight, leader = async_flights.join((cache_key,))
+        if leader:
+            break
+        # Someone is already generating this; wait for their final result instead of streaming a copy
+        result = await _superseding(session_id, async_flights.wait(flight))
+        if result is not None:
+            yield "result", (copy.deepcopy(result[0]), result[1])
+            return
+        # Their caller went away before the result was in; take over
+
+    events = asyncio.Queue()
+
+    async def read():
+        # The provider stream is read in its own task, so that a supersede aborts the HTTP response
+        # right away instead of when the next chunk arrives
+        stream = _dispatch_stream_async(llm_type, api_key, user_input, **kwargs)
+        try:
+            async for event in stream:
+                events.put_nowait(event)
+        finally:
+            await stream.aclose()
+            events.put_nowait(None)
+
+    reader = asyncio.ensure_future(read())
+    superseded = False
+
+    def supersede():
+        nonlocal superseded
+        superseded = True
+        # With other callers waiting on this flight the stream is read to the end silently
+        if flight.waiters <= 1:
+            reader.cancel()
+
+    if session_id:
+        async_session_requests.start(session_id, supersede)
+    collector = _StreamCollector(llm_type)
+    result = None # Stays None when this generator is abandoned, so that callers waiting on the flight take over
     try:
-        json_match = re.search(r'\{.*\}', text, re.DOTALL)
-        if json_match:
-            data = json.loads(json_match.group(0))
-            return data, None
-        else:
-            return None, f"Failed to parse JSON response from {model_name}."
-    except Exception as e:
-        return None, f"JSON parse error from {model_name}: {str(e)}"
-
-def generate_prompts(llm_type, api_key, user_input, **kwargs):
-    if llm_type == "ChatGPT":
-        return generate_prompts_openai(api_key, user_input, **kwargs)
-    elif llm_type == "Grok":
-        return generate_prompts_grok(api_key, user_input, **kwargs)
-    elif "Gemini" in llm_type:
-        return generate_prompts_gemini(api_key, user_input, model_preference=llm_type, **kwargs)
-    else:
-        return generate_prompts_gemini(api_key, user_input, **kwargs)
+        while True:
+            event = await events.get()
+            if event is None:
+                if superseded:
+                    result = (None, SUPERSEDED_ERROR)
+                else:
+                    await reader # Raises whatever ended the provider stream
+                    result = (None, "The response stream ended unexpectedly.")
+                break
+            kind, value = event
+            if superseded and flight.waiters <= 1:
+                # The other callers went away meanwhile
+                result = (None, SUPERSEDED_ERROR)
+                break
+            if kind == "text":
+                if collector.text(value) and not superseded:
+                    yield "partial", collector.partial()
+            elif kind == "error":
+                result = (None, value)
+                break
+            else:
+                result = collector.done(value)
+                if not result[1] and result[0]:
+                    await asyncio.to_thread(_remember, cache_key, result[0], kwargs.get("model") or resolve_model(llm_type))
+                break
+    finally:
+        reader.cancel()
+        try:
+            await reader
+        except (asyncio.CancelledError, Exception):
+            pass
+        async_flights.complete((cache_key,), flight, result)
+        async_flights.leave(flight)
+        if session_id:
+            async_session_requests.finish(session_id, supersede)
+    yield "result", (None, SUPERSEDED_ERROR) if superseded else result
+
+def variant_batches(count, per_call):
+    # Near-equal batches of at most per_call, e.g. 8 by 4 -> [4, 4] and 6 by 4 -> [3, 3]
+    batches = -(-count // max(1, per_call))
+    return [count // batches + (1 if i < count % batches else 0) for i in range(batches)]
+
+def _collect_variants(results, variants, seen, errors):
+    for data, error in results:
+        if error:
+            errors.append(error)
+            continue
+        # A batch of one comes back as a plain pair
+        for variant in data.get("variants", [data]) if data else []:
+            key = frozenset(t.lower() for t in tokenize(variant["positive"]))
+            if key and key not in seen:
+                seen.add(key)
+                variants.append(variant)
+
+async def generate_variants_async(llm_type, api_key, user_input, count, api_keys=None, session_id=None, **kwargs):
+    # Returns ({"variants": [{"positive", "negative", "pos_mapping", "neg_mapping"}, ...]}, error).
+    # Each batch goes through generate_prompts_async, so caching, coalescing and the tag dictionary apply per batch.
+    count = max(1, min(int(count), MAX_VARIANTS))
+    # Resolved once so that every batch goes to the same model
+    # The known tags may have to be loaded from disk first
+    llm_type, api_key, error = await asyncio.to_thread(_prepare, llm_type, api_key, api_keys, kwargs)
+    if error:
+        return None, error
+    per_call = provider_for_llm_type(llm_type).options.get("max_variants_per_call", MAX_VARIANTS_PER_CALL)
+
+    def batch(size, index):
+        return generate_prompts_async(llm_type, api_key, user_input, variants=size, variant_batch=index, **kwargs)
+
+    async def run():
+        sizes = variant_batches(count, per_call)
+        variants, seen, errors = [], set(), []
+        _collect_variants(await asyncio.gather(*(batch(size, i) for i, size in enumerate(sizes))), variants, seen, errors)
+        missing = count - len(variants)
+        if missing > 0 and (variants or any(e.startswith(PARSE_ERROR_PREFIX) for e in errors)):
+            # Short, duplicated or truncated responses: the rest come from single-variant calls, which fit any output limit
+            metrics.count("variant_topups")
+            _collect_variants(await asyncio.gather(*(batch(1, len(sizes) + i) for i in range(missing))), variants, seen, errors)
+        if not variants:
+            return None, errors[0] if errors else "No variants were returned."
+        return {"variants": variants[:count]}, None
+
+    # The batches share one session slot, so they do not supersede each other
+    return await _superseding(session_id, run())
+
+def cancel_session(session_id):
+    # Stops the session's pending request, sync or async; its caller receives SUPERSEDED_ERROR
+    if session_id:
+        async_session_requests.cancel(session_id)
+        session_requests.cancel(session_id)
+
+def get_cache_stats():
+    return response_cache.stats()
+
+def get_dictionary_stats():
+    return tag_dictionary.stats()
+
+def get_usage_stats():
+    # Token totals per provider, including how much of the prompts their prompt caches served
+    return usage_stats()
+
+def get_router_stats():
+    return model_router.snapshot(), model_router.last_decision
@@ -0,0 +1,102 @@
+import importlib
+import os
+import threading
+
+# Backends are described here without importing them; each backend module (and its SDK)
+# is only loaded when a request first needs it, so webui startup never pays for unused SDKs.
+
+_load_lock = threading.Lock()
+
+class Provider:
+    def __init__(self, name, module_name, label, llm_type, default_model, llm_type_prefix=None, **options):
+        self.name = name
+        self.module_name = module_name
+        self.label = label
+        # Canonical LLM selection for this backend, used when the router picks it
+        self.llm_type = llm_type
+        self.llm_type_prefix = llm_type_prefix
+        self.default_model = default_model
+        self.options = options
+        self._module = None
+
+    def handles(self, llm_type):
+        return llm_type == self.llm_type or bool(self.llm_type_prefix and llm_type.startswith(self.llm_type_prefix))
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    @property
+    def module(self):
+        if self._module is None:
+            with _load_lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self.module_name)
+        return self._module
+
+    def resolve_model(self, llm_type):
+        models = self.options.get("model_lists", {}).get(llm_type)
+        return models[0] if models else self.default_model
+
+    def generate(self, api_key, user_input, **kwargs):
+        return self.module.generate(self, api_key, user_input, **kwargs)
+
+    def stream(self, api_key, user_input, **kwargs):
+        return self.module.stream(self, api_key, user_input, **kwargs)
+
+    async def generate_async(self, api_key, user_input, **kwargs):
+        return await self.module.generate_async(self, api_key, user_input, **kwargs)
+
+    def stream_async(self, api_key, user_input, **kwargs):
+        return self.module.stream_async(self, api_key, user_input, **kwargs)
+
+    def auto_models(self, api_key):
+        return self.module.auto_models(self, api_key)
+
+_registry = {}
+DEFAULT_PROVIDER = "gemini"
+
+def register(provider):
+    _registry[provider.name] = provider
+
+def get_provider(name):
+    return _registry[name]
+
+def providers():
+    return list(_registry.values())
+
+def set_base_url(name, base_url):
+    # Points a backend at another endpoint (a proxy, or the local fake server in benchmarks/)
+    _registry[name].options["base_url"] = base_url or None
+
+def provider_for_llm_type(llm_type):
+    for provider in _registry.values():
+        if provider.handles(llm_type):
+            return provider
+    return _registry[DEFAULT_PROVIDER]
+
+register(Provider(
+    "gemini", "llm_providers.gemini", "Gemini", "Gemini", "gemini-1.5-flash", llm_type_prefix="Gemini",
+    model_lists={
+        "Gemini 3.0": ['gemini-3.0-pro', 'gemini-3.0-flash'],
+        "Gemini 2.0": ['gemini-2.0-flash', 'gemini-2.0-flash-exp'],
+        "Gemini 1.5": ['gemini-1.5-flash', 'gemini-1.5-pro']
+    },
+    default_models=['gemini-1.5-flash', 'gemini-2.0-flash', 'gemini-1.5-pro'],
+    context_cache=True,
+))
+register(Provider(
+    "openai", "llm_providers.openai_compat", "OpenAI", "ChatGPT", "gpt-4o-mini",
+    response_format="json_schema", prompt_cache_key=True, stream_usage=True,
+))
+# Models without structured outputs (grok-beta) reject json_schema; openai_compat then falls back to json_object
+register(Provider(
+    "grok", "llm_providers.openai_compat", "Grok", "Grok", "grok-beta",
+    base_url="https://api.x.ai/v1", response_format="json_schema", stream_usage=True,
+))
+
+# AIPI_<NAME>_BASE_URL overrides the endpoint of any backend, e.g. AIPI_OPENAI_BASE_URL=http://127.0.0.1:8765/v1
+for _provider in providers():
+    _base_url = os.environ.get(f"AIPI_{_provider.name.upper()}_BASE_URL")
+    if _base_url:
+        set_base_url(_provider.name, _base_url)
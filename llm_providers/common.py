@@ -0,0 +1,94 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from prompt_builder import system_prompt, user_prompt
+from rate_limit import remaining
+
+def timeout_options(deadline):
+    # Keep each network call inside the request deadline
+    return {"timeout": remaining(deadline)} if deadline is not None else {}
+
+def error_outcome(error):
+    return "rate_limited" if "429" in error else "error"
+
+def prompt_parts(user_input, kwargs):
+    # (static system prefix, per-request suffix); the prefix goes first so that provider prompt caches can hit
+    return system_prompt(kwargs.get("known_tags")), user_prompt(user_input, kwargs.get("quality_tags"), kwargs.get("variants", 1), kwargs.get("variant_batch", 0))
+
+_usage_lock = threading.Lock()
+_usage = {} # provider -> token totals since startup
+
+def record_usage(provider, prompt_tokens, cached_tokens, output_tokens):
+    # Token counts from the provider's usage metadata; cached_tokens is the part of the prompt served from its prompt cache
+    prompt_tokens, cached_tokens, output_tokens = prompt_tokens or 0, cached_tokens or 0, output_tokens or 0
+    if not (prompt_tokens or output_tokens):
+        return
+    with _usage_lock:
+        totals = _usage.setdefault(provider, {"responses": 0, "prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0})
+        totals["responses"] += 1
+        totals["prompt_tokens"] += prompt_tokens
+        totals["cached_tokens"] += cached_tokens
+        totals["output_tokens"] += output_tokens
+    metrics.count("prompt_tokens", prompt_tokens)
+    metrics.count("cached_tokens", cached_tokens)
+    metrics.count("output_tokens", output_tokens)
+
+def usage_stats():
+    with _usage_lock:
+        return {provider: dict(totals) for provider, totals in _usage.items()}
+
+# Sync provider calls made from async code run here, never on the event loop
+_blocking_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="aipi-blocking")
+
+async def run_blocking(fn, *args, **kwargs):
+    # fn must accept cancel_event, which is set when the awaiting task is cancelled so the thread stops early
+    cancel_event = threading.Event()
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **dict(kwargs, cancel_event=cancel_event))
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_blocking_executor, call)
+    except asyncio.CancelledError:
+        cancel_event.set()
+        raise
+
+async def iterate_blocking(gen_fn, *args, **kwargs):
+    # Async iteration over a sync generator that runs on a worker thread; like run_blocking,
+    # cancellation sets the cancel_event it was given and the thread stops at the next item
+    cancel_event = threading.Event()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    finished = object()
+
+    def post(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            cancel_event.set() # The loop is gone
+
+    def pump():
+        outcome = None
+        events = gen_fn(*args, **dict(kwargs, cancel_event=cancel_event))
+        try:
+            for event in events:
+                if cancel_event.is_set():
+                    break
+                post(event)
+        except Exception as e:
+            outcome = e
+        finally:
+            events.close()
+        post((finished, outcome))
+
+    loop.run_in_executor(_blocking_executor, contextvars.copy_context().run, pump)
+    try:
+        while True:
+            event = await queue.get()
+            if event[0] is finished:
+                if event[1] is not None:
+                    raise event[1]
+                return
+            yield event
+    finally:
+        cancel_event.set()
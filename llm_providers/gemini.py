@@ -0,0 +1,421 @@
+import asyncio
+import contextvars
+import datetime
+import hashlib
+import itertools
+import threading
+import time
+import metrics
+from client_pool import client_pool
+from gemini_models import GeminiModelResolver
+from prompt_builder import parse_json_response, gemini_response_schema, RESPONSE_SCHEMA, RESPONSE_SCHEMA_VARIANTS, SYSTEM_PROMPT_VERSION
+from rate_limit import call_with_retry, call_with_retry_async, Cancelled, DeadlineExceeded
+from router import model_router
+from llm_providers import get_provider
+from llm_providers.common import timeout_options, error_outcome, run_blocking, iterate_blocking, prompt_parts, record_usage
+
+def _genai():
+    # Imported on first use only; google.generativeai is slow to import
+    import google.generativeai as genai
+    return genai
+
+class GeminiClients:
+    # Per-key clients, so concurrent users with different keys never share genai.configure state
+    def __init__(self, api_key, base_url=None):
+        from google.ai import generativelanguage as glm
+        client_options = {"api_key": api_key}
+        # Custom endpoints (proxies, the benchmark server) are reached over REST; the default is gRPC
+        transport = None
+        if base_url:
+            client_options["api_endpoint"] = base_url
+            transport = "rest"
+        self.generative = glm.GenerativeServiceClient(client_options=client_options, transport=transport)
+        self.models = glm.ModelServiceClient(client_options=client_options, transport=transport)
+        self.cache = glm.CacheServiceClient(client_options=client_options, transport=transport)
+
+    def close(self):
+        for c in (self.generative, self.models, self.cache):
+            try:
+                c.transport.close()
+            except Exception:
+                pass
+
+class GeminiAsyncClients:
+    # grpc.aio client for the async entry points; one per key and event loop
+    def __init__(self, api_key, base_url=None):
+        from google.ai import generativelanguage as glm
+        self.generative = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+
+    async def close(self):
+        try:
+            await self.generative.transport.close()
+        except Exception:
+            pass
+
+def lease_async_clients(api_key):
+    # Context manager; the pool keeps the clients open while they are leased
+    return client_pool.lease("gemini", api_key, GeminiAsyncClients, variant=("async", id(asyncio.get_running_loop())))
+
+def lease_clients(api_key):
+    return client_pool.lease("gemini", api_key, GeminiClients, base_url=get_provider("gemini").options.get("base_url"))
+
+def _list_models(api_key):
+    with lease_clients(api_key) as clients, metrics.span("list_models"):
+        return [m.name for m in _genai().list_models(client=clients.models) if 'generateContent' in m.supported_generation_methods]
+
+resolver = GeminiModelResolver(_list_models)
+
+# Native JSON mode constrained to the response schema
+GENERATION_CONFIG = {"response_mime_type": "application/json", "response_schema": gemini_response_schema(RESPONSE_SCHEMA)}
+GENERATION_CONFIG_VARIANTS = {"response_mime_type": "application/json", "response_schema": gemini_response_schema(RESPONSE_SCHEMA_VARIANTS)}
+
+def generation_config(variants=1):
+    return GENERATION_CONFIG_VARIANTS if variants > 1 else GENERATION_CONFIG
+
+# Lifetime of a cached-content resource holding the static prompt prefix
+CONTEXT_CACHE_TTL_SECONDS = 60 * 60
+# A cache is replaced this long before it expires, so no request is sent against an expired one
+CONTEXT_CACHE_MARGIN_SECONDS = 5 * 60
+# After a refusal (prefix below the model's minimum cacheable size, model without caching), try again this much later
+CONTEXT_CACHE_RETRY_SECONDS = 6 * 60 * 60
+
+class ContextCaches:
+    # The static system prefix registered once per API key and model as Gemini cached content, so requests
+    # only send the per-request suffix. Models that refuse fall back to a plain system instruction.
+    def __init__(self):
+        self._entries = {} # (key hash, model) -> {"prefix": digest, "name": str or None, "expires": time}
+        self._creating = {} # (key hash, model) -> lock, so only one caller creates a cache
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(api_key, model_name):
+        return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16], model_name
+
+    def lookup(self, api_key, model_name, prefix):
+        # Returns (found, name) without any network call; name is None when the model does not cache
+        entry = self._entries.get(self._key(api_key, model_name))
+        if entry is not None and entry["prefix"] == _digest(prefix) and entry["expires"] > time.time():
+            return True, entry["name"]
+        return False, None
+
+    def get(self, api_key, model_name, prefix):
+        found, name = self.lookup(api_key, model_name, prefix)
+        if found:
+            return name
+        key = self._key(api_key, model_name)
+        with self._lock:
+            creating = self._creating.setdefault(key, threading.Lock())
+        with creating:
+            found, name = self.lookup(api_key, model_name, prefix)
+            if found:
+                return name
+            try:
+                with lease_clients(api_key) as clients, metrics.span("context_cache"):
+                    cached = clients.cache.create_cached_content(cached_content={
+                        "model": f"models/{model_name}",
+                        "display_name": f"aipi-prompt-v{SYSTEM_PROMPT_VERSION}",
+                        "system_instruction": {"parts": [{"text": prefix}]},
+                        "ttl": datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS),
+                    })
+                name, expires = cached.name, time.time() + CONTEXT_CACHE_TTL_SECONDS - CONTEXT_CACHE_MARGIN_SECONDS
+            except Exception as e:
+                print(f"[AIPI] Gemini context caching is not available for {model_name}; sending the prompt in full: {e}")
+                name, expires = None, time.time() + CONTEXT_CACHE_RETRY_SECONDS
+            with self._lock:
+                previous = self._entries.get(key)
+                self._entries[key] = {"prefix": _digest(prefix), "name": name, "expires": expires}
+        if previous is not None and previous["name"] and previous["name"] != name:
+            # Cached content is billed for storage until it expires, so the one replaced goes now
+            self._delete(api_key, previous["name"])
+        return name
+
+    def _delete(self, api_key, name):
+        try:
+            with lease_clients(api_key) as clients:
+                clients.cache.delete_cached_content(name=name)
+        except Exception as e:
+            print(f"[AIPI] Error deleting Gemini cached content {name}: {e}")
+
+    def invalidate(self, api_key, model_name, name):
+        # Forgets a cache that Google no longer has; an entry already replaced by a newer cache is kept
+        key = self._key(api_key, model_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["name"] == name:
+                del self._entries[key]
+
+def _digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+context_caches = ContextCaches()
+
+def _uses_context_cache():
+    return bool(get_provider("gemini").options.get("context_cache"))
+
+def _is_cache_error(error):
+    # The cache was deleted or expired on Google's side before our own expiry
+    return "cachedcontent" in str(error).lower()
+
+def _new_model(clients, model_name, system=None, cached_content=None, use_async=False):
+    if cached_content:
+        model = _genai().GenerativeModel(model_name)
+        model._cached_content = cached_content # What GenerativeModel.from_cached_content sets, without its extra lookup
+    else:
+        model = _genai().GenerativeModel(model_name, system_instruction=system)
+    # Reuse the pooled connection instead of the global default client
+    if use_async:
+        model._async_client = clients.generative
+    else:
+        model._client = clients.generative
+    return model
+
+def _record_usage(usage):
+    if usage:
+        record_usage("gemini", usage.prompt_token_count, usage.cached_content_token_count, usage.candidates_token_count)
+
+def _generate_content(clients, api_key, model_name, system, prompt, stream=False, **options):
+    # Returns the response, or (first chunk, chunk iterator) when streaming, since errors only surface on the first chunk
+    cache_name = context_caches.get(api_key, model_name, system) if _uses_context_cache() else None
+
+    def attempt(cached_content):
+        response = _new_model(clients, model_name, system, cached_content).generate_content(prompt, stream=stream, **options)
+        if not stream:
+            return response
+        chunks = iter(response)
+        return next(chunks, None), chunks
+
+    try:
+        return attempt(cache_name)
+    except Exception as e:
+        if cache_name is None or not _is_cache_error(e):
+            raise
+        context_caches.invalidate(api_key, model_name, cache_name)
+        return attempt(None)
+
+async def _generate_content_async(clients, api_key, model_name, system, prompt, stream=False, **options):
+    # Async counterpart of _generate_content
+    cache_name = None
+    if _uses_context_cache():
+        found, cache_name = context_caches.lookup(api_key, model_name, system)
+        if not found:
+            # Creating the cache is a blocking call on the sync client
+            cache_name = await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run, context_caches.get, api_key, model_name, system)
+
+    async def attempt(cached_content):
+        response = await _new_model(clients, model_name, system, cached_content, use_async=True).generate_content_async(prompt, stream=stream, **options)
+        if not stream:
+            return response
+        chunks = response.__aiter__()
+        try:
+            return await chunks.__anext__(), chunks
+        except StopAsyncIteration:
+            return None, chunks
+
+    try:
+        return await attempt(cache_name)
+    except Exception as e:
+        if cache_name is None or not _is_cache_error(e):
+            raise
+        context_caches.invalidate(api_key, model_name, cache_name)
+        return await attempt(None)
+
+async def _next_candidate(candidates):
+    # The resolver may have to list models over the network as a last resort; keep that off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, next, candidates, None)
+
+def _candidates(provider, api_key, model_preference, model):
+    preferred_models = [model] if model else provider.options["model_lists"].get(model_preference, [])
+    return resolver.candidates(api_key, preferred_models, provider.options["default_models"], model_preference)
+
+def auto_models(provider, api_key):
+    models = []
+    for m in [m for ms in provider.options["model_lists"].values() for m in ms] + provider.options["default_models"]:
+        if m not in models and resolver.is_healthy(api_key, m):
+            models.append(m)
+    return models
+
+class _Attempts:
+    # The model fallback shared by generate, stream and their async versions, which differ only in how they wait:
+    # known-good model first, failed models skipped, full listing only as a last resort
+    def __init__(self, provider, api_key, model_preference, model):
+        self.api_key = api_key
+        self.model_preference = model_preference
+        self.candidates = _candidates(provider, api_key, model_preference, model)
+        self.tried = 0
+        self.last_error = None
+        self.model_name = None
+        self.started = None
+
+    def start(self, model_name):
+        self.model_name = model_name
+        self.tried += 1
+        metrics.count("models_tried")
+        self.started = time.monotonic()
+
+    def latency(self):
+        return time.monotonic() - self.started
+
+    def succeeded(self, usage):
+        resolver.record_success(self.api_key, self.model_name, self.model_preference)
+        _record_usage(usage)
+
+    def parse(self, response, variants):
+        self.succeeded(response.usage_metadata)
+        with metrics.span("parse"):
+            data, error = parse_json_response(response.text, self.model_name, variants)
+        model_router.record("gemini", self.model_name, self.latency(), "parse_error" if error else "ok")
+        return data, error
+
+    def failed(self, e, streamed=False):
+        # Returns the error to report, or None to fall back to the next model
+        if isinstance(e, (Cancelled, DeadlineExceeded)):
+            # Given up before the model answered; says nothing about the model's health
+            return f"Error with {self.model_name}: {e}"
+        self.last_error = str(e)
+        resolver.record_failure(self.api_key, self.model_name, self.last_error)
+        model_router.record("gemini", self.model_name, self.latency(), error_outcome(self.last_error))
+        # Falling back is only possible before any text has been shown
+        if not streamed and ("404" in self.last_error or "429" in self.last_error):
+            metrics.count("model_fallbacks")
+            return None
+        return f"Error with {self.model_name}: {self.last_error}"
+
+    def exhausted(self):
+        return f"All Gemini models ({self.tried}) failed. Please try ChatGPT instead. Last error: {self.last_error}"
+
+def _request(user_input, kwargs, stream=False):
+    # Keyword arguments for _generate_content; request_options is computed per attempt, inside the deadline
+    system, prompt = prompt_parts(user_input, kwargs)
+    return dict(system=system, prompt=prompt, stream=stream, generation_config=generation_config(kwargs.get("variants", 1)))
+
+def _chunk_text(chunk, usage):
+    # (text, usage so far); the last chunk carries the complete usage
+    return chunk.text, chunk.usage_metadata or usage
+
+def generate(provider, api_key, user_input, model_preference=None, model=None, **kwargs):
+    if not api_key:
+        return None, "Gemini API Key is required."
+
+    attempts = _Attempts(provider, api_key, model_preference, model)
+    request = _request(user_input, kwargs)
+    deadline = kwargs.get("deadline")
+    with lease_clients(api_key) as clients:
+        for model_name in attempts.candidates:
+            attempts.start(model_name)
+            try:
+                response = call_with_retry("gemini", api_key, lambda: _generate_content(clients, api_key, model_name, request_options=timeout_options(deadline), **request), deadline, kwargs.get("cancel_event"))
+                return attempts.parse(response, kwargs.get("variants", 1))
+            except Exception as e:
+                error = attempts.failed(e)
+                if error:
+                    return None, error
+
+    return None, attempts.exhausted()
+
+def stream(provider, api_key, user_input, model_preference=None, model=None, **kwargs):
+    # Yields ("text", chunk) while streaming, then ("done", (model_name, latency)) or ("error", message)
+    if not api_key:
+        yield "error", "Gemini API Key is required."
+        return
+
+    attempts = _Attempts(provider, api_key, model_preference, model)
+    request = _request(user_input, kwargs, stream=True)
+    deadline = kwargs.get("deadline")
+    with lease_clients(api_key) as clients:
+        for model_name in attempts.candidates:
+            attempts.start(model_name)
+            streamed = False
+            try:
+                # Errors surface on the first chunk, so only that part is retried
+                first, chunks = call_with_retry("gemini", api_key, lambda: _generate_content(clients, api_key, model_name, request_options=timeout_options(deadline), **request), deadline, kwargs.get("cancel_event"))
+                usage = None
+                for chunk in itertools.chain([first] if first is not None else [], chunks):
+                    text, usage = _chunk_text(chunk, usage)
+                    if text:
+                        streamed = True
+                        yield "text", text
+
+                attempts.succeeded(usage)
+                yield "done", (model_name, attempts.latency())
+                return
+            except Exception as e:
+                error = attempts.failed(e, streamed)
+                if error:
+                    yield "error", error
+                    return
+
+    yield "error", attempts.exhausted()
+
+async def generate_async(provider, api_key, user_input, model_preference=None, model=None, **kwargs):
+    # Same as generate(); cancelling the awaiting task aborts the request in flight
+    if provider.options.get("base_url"):
+        # Custom endpoints are reached over REST, which the SDK only offers synchronously
+        return await run_blocking(generate, provider, api_key, user_input, model_preference=model_preference, model=model, **kwargs)
+    if not api_key:
+        return None, "Gemini API Key is required."
+
+    attempts = _Attempts(provider, api_key, model_preference, model)
+    request = _request(user_input, kwargs)
+    deadline = kwargs.get("deadline")
+    with lease_async_clients(api_key) as clients:
+        while True:
+            model_name = await _next_candidate(attempts.candidates)
+            if model_name is None:
+                break
+            attempts.start(model_name)
+            try:
+                response = await call_with_retry_async("gemini", api_key, lambda: _generate_content_async(clients, api_key, model_name, request_options=timeout_options(deadline), **request), deadline)
+                return attempts.parse(response, kwargs.get("variants", 1))
+            except Exception as e:
+                error = attempts.failed(e)
+                if error:
+                    return None, error
+
+    return None, attempts.exhausted()
+
+async def stream_async(provider, api_key, user_input, model_preference=None, model=None, **kwargs):
+    # Async counterpart of stream(), with the same events
+    if provider.options.get("base_url"):
+        # No async REST transport; the sync stream runs in a worker thread instead
+        async for event in iterate_blocking(stream, provider, api_key, user_input, model_preference=model_preference, model=model, **kwargs):
+            yield event
+        return
+    if not api_key:
+        yield "error", "Gemini API Key is required."
+        return
+
+    attempts = _Attempts(provider, api_key, model_preference, model)
+    request = _request(user_input, kwargs, stream=True)
+    deadline = kwargs.get("deadline")
+    with lease_async_clients(api_key) as clients:
+        while True:
+            model_name = await _next_candidate(attempts.candidates)
+            if model_name is None:
+                break
+            attempts.start(model_name)
+            streamed = False
+            try:
+                # Errors surface on the first chunk, so only that part is retried
+                first, chunks = await call_with_retry_async("gemini", api_key, lambda: _generate_content_async(clients, api_key, model_name, request_options=timeout_options(deadline), **request), deadline)
+                usage = None
+                if first is not None:
+                    text, usage = _chunk_text(first, usage)
+                    if text:
+                        streamed = True
+                        yield "text", text
+                    async for chunk in chunks:
+                        text, usage = _chunk_text(chunk, usage)
+                        if text:
+                            streamed = True
+                            yield "text", text
+
+                attempts.succeeded(usage)
+                yield "done", (model_name, attempts.latency())
+                return
+            except Exception as e:
+                error = attempts.failed(e, streamed)
+                if error:
+                    yield "error", error
+                    return
+
+    yield "error", attempts.exhausted()
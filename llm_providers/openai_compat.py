@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import time
+import metrics
+from client_pool import client_pool
+from prompt_builder import parse_json_response, openai_response_format
+from rate_limit import call_with_retry, call_with_retry_async, status_of, Cancelled, DeadlineExceeded
+from router import model_router
+from llm_providers.common import timeout_options, error_outcome, prompt_parts, record_usage
+
+# Serves every backend that speaks the OpenAI chat completions API (OpenAI itself, xAI Grok, ...)
+
+# Tried in order when an endpoint rejects the response format, e.g. a model without structured outputs
+RESPONSE_FORMAT_FALLBACKS = ["json_schema", "json_object", None]
+
+_response_formats = {} # (provider, model) -> format the endpoint accepted after rejecting the configured one
+_fallback_noticed = False
+
+def _new_client(api_key, base_url):
+    # Imported on first use only
+    import openai
+    # Retries are handled by rate_limit.call_with_retry so that they share the per-key token bucket
+    return openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+def _new_async_client(api_key, base_url):
+    import openai
+    return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+def lease_client(provider, api_key):
+    # Context manager; the pool keeps the client open while it is leased
+    return client_pool.lease(provider.name, api_key, _new_client, base_url=provider.options.get("base_url"))
+
+def lease_async_client(provider, api_key):
+    # httpx async connections belong to the event loop they were opened on
+    return client_pool.lease(provider.name, api_key, _new_async_client, base_url=provider.options.get("base_url"), variant=("async", id(asyncio.get_running_loop())))
+
+def _response_format_mode(provider, model_name):
+    return _response_formats.get((provider.name, model_name), provider.options.get("response_format"))
+
+def _rejects_response_format(error):
+    # A 400 about the requested output format rather than about the prompt
+    text = str(error).lower()
+    return status_of(error) == 400 and ("response_format" in text or "json_schema" in text)
+
+def _set_response_format(args, mode, variants):
+    response_format = openai_response_format(mode, variants)
+    if response_format:
+        args["response_format"] = response_format
+    else:
+        args.pop("response_format", None)
+
+def _create_args(provider, model_name, user_input, kwargs, stream=False):
+    system, prompt = prompt_parts(user_input, kwargs)
+    args = dict(
+        model=model_name,
+        # The static system message comes first, so the provider's automatic prefix caching can reuse it
+        messages=[{"role": "system", "content": system}, {"role": "user", "content": prompt}],
+    )
+    # Schema-constrained output, so the reply is always the bare JSON object
+    _set_response_format(args, _response_format_mode(provider, model_name), kwargs.get("variants", 1))
+    if provider.options.get("prompt_cache_key"):
+        # Requests sharing the prefix are routed to the same cache; sent as extra_body so older SDKs accept it
+        args["extra_body"] = {"prompt_cache_key": "aipi-" + hashlib.sha256(system.encode("utf-8")).hexdigest()[:16]}
+    if stream:
+        args["stream"] = True
+        if provider.options.get("stream_usage"):
+            # Adds a final chunk carrying the usage, including cached tokens
+            args["stream_options"] = {"include_usage": True}
+    return args
+
+def _record_usage(provider, usage):
+    if usage is not None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        record_usage(provider.name, usage.prompt_tokens, getattr(details, "cached_tokens", None), usage.completion_tokens)
+
+def auto_models(provider, api_key):
+    return [provider.default_model]
+
+class _Call:
+    # Bookkeeping shared by generate, stream and their async versions, which differ only in how they wait
+    def __init__(self, provider, model, user_input, kwargs, stream=False):
+        self.provider = provider
+        self.model_name = model or provider.default_model
+        self.variants = kwargs.get("variants", 1)
+        self.deadline = kwargs.get("deadline")
+        self.args = _create_args(provider, self.model_name, user_input, kwargs, stream)
+        metrics.count("models_tried")
+        self.started = time.monotonic()
+
+    def create(self, client):
+        # The timeout is computed per attempt, inside the deadline
+        while True:
+            try:
+                return client.chat.completions.create(**self.args, **timeout_options(self.deadline))
+            except Exception as e:
+                if not self._fall_back(e):
+                    raise
+
+    async def create_async(self, client):
+        while True:
+            try:
+                return await client.chat.completions.create(**self.args, **timeout_options(self.deadline))
+            except Exception as e:
+                if not self._fall_back(e):
+                    raise
+
+    def _fall_back(self, e):
+        # On a rejected response format, switches to the next plainer one (remembered for the model) and
+        # returns True to send the request again; the rejection is not a model failure
+        mode = self.args.get("response_format", {}).get("type")
+        if not _rejects_response_format(e) or mode not in RESPONSE_FORMAT_FALLBACKS[:-1]:
+            return False
+        global _fallback_noticed
+        fallback = RESPONSE_FORMAT_FALLBACKS[RESPONSE_FORMAT_FALLBACKS.index(mode) + 1]
+        metrics.count("response_format_fallbacks")
+        if not _fallback_noticed:
+            # Expected for some endpoints on every start, so it is told once; later fallbacks only count
+            _fallback_noticed = True
+            print(f"[AIPI] {self.provider.label} {self.model_name} rejected response_format {mode}; using {fallback or 'none'} instead (further fallbacks are counted in metrics): {e}")
+        _response_formats[(self.provider.name, self.model_name)] = fallback
+        _set_response_format(self.args, fallback, self.variants)
+        return True
+
+    def latency(self):
+        return time.monotonic() - self.started
+
+    def parse(self, response):
+        _record_usage(self.provider, response.usage)
+        with metrics.span("parse"):
+            data, error = parse_json_response(response.choices[0].message.content, self.model_name, self.variants)
+        model_router.record(self.provider.name, self.model_name, self.latency(), "parse_error" if error else "ok")
+        return data, error
+
+    def chunk_text(self, chunk):
+        if chunk.usage:
+            _record_usage(self.provider, chunk.usage)
+        if chunk.choices:
+            return chunk.choices[0].delta.content
+        return None
+
+    def done(self):
+        return self.model_name, self.latency()
+
+    def failed(self, e):
+        if not isinstance(e, (Cancelled, DeadlineExceeded)):
+            # Giving up before the model answered says nothing about the model's health
+            model_router.record(self.provider.name, self.model_name, self.latency(), error_outcome(str(e)))
+        return f"{self.provider.label} Error: {str(e)}"
+
+def generate(provider, api_key, user_input, model=None, **kwargs):
+    if not api_key:
+        return None, f"{provider.label} API Key is required."
+
+    call = _Call(provider, model, user_input, kwargs)
+    try:
+        with lease_client(provider, api_key) as client:
+            response = call_with_retry(provider.name, api_key, lambda: call.create(client), call.deadline, kwargs.get("cancel_event"))
+        return call.parse(response)
+    except Exception as e:
+        return None, call.failed(e)
+
+def stream(provider, api_key, user_input, model=None, **kwargs):
+    # Yields ("text", chunk) while streaming, then ("done", (model_name, latency)) or ("error", message)
+    if not api_key:
+        yield "error", f"{provider.label} API Key is required."
+        return
+
+    call = _Call(provider, model, user_input, kwargs, stream=True)
+    try:
+        with lease_client(provider, api_key) as client:
+            response = call_with_retry(provider.name, api_key, lambda: call.create(client), call.deadline, kwargs.get("cancel_event"))
+            try:
+                for chunk in response:
+                    text = call.chunk_text(chunk)
+                    if text:
+                        yield "text", text
+            finally:
+                # Also runs when the consumer abandons the stream, which aborts the HTTP response
+                response.close()
+        yield "done", call.done()
+    except Exception as e:
+        yield "error", call.failed(e)
+
+async def generate_async(provider, api_key, user_input, model=None, **kwargs):
+    # Same as generate(); cancelling the awaiting task aborts the HTTP request
+    if not api_key:
+        return None, f"{provider.label} API Key is required."
+
+    call = _Call(provider, model, user_input, kwargs)
+    try:
+        with lease_async_client(provider, api_key) as client:
+            response = await call_with_retry_async(provider.name, api_key, lambda: call.create_async(client), call.deadline)
+        return call.parse(response)
+    except Exception as e:
+        return None, call.failed(e)
+
+async def stream_async(provider, api_key, user_input, model=None, **kwargs):
+    # Async counterpart of stream(), with the same events
+    if not api_key:
+        yield "error", f"{provider.label} API Key is required."
+        return
+
+    call = _Call(provider, model, user_input, kwargs, stream=True)
+    try:
+        with lease_async_client(provider, api_key) as client:
+            response = await call_with_retry_async(provider.name, api_key, lambda: call.create_async(client), call.deadline)
+            try:
+                async for chunk in response:
+                    text = call.chunk_text(chunk)
+                    if text:
+                        yield "text", text
+            finally:
+                await response.close()
+        yield "done", call.done()
+    except Exception as e:
+        yield "error", call.failed(e)
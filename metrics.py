@@ -0,0 +1,164 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+metrics_path = os.path.join(base_dir, "metrics.jsonl")
+
+# One JSON line per request; the file is rotated to metrics.jsonl.1 when it grows past this
+MAX_FILE_BYTES = 1024 * 1024
+# Upper bounds (seconds) of the Prometheus histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Off unless asked for; every entry point checks this flag before doing any work
+enabled = os.environ.get("AIPI_METRICS", "") not in ("", "0")
+
+_lock = threading.Lock()
+_stages = {} # stage -> [bucket counts..., +Inf count, sum]
+_counters = {}
+# Per thread and per asyncio task, so concurrent requests never share a trace
+_current_trace = contextvars.ContextVar("aipi_trace", default=None)
+last_trace = None
+# Traces are appended to the file by this thread, so end_trace() is safe to call on the event loop
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aipi-metrics-writer")
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.started)
+        return False
+
+def set_enabled(value):
+    global enabled
+    enabled = bool(value)
+
+def span(name):
+    # with metrics.span("parse"): ...  -- a shared no-op object while metrics are disabled
+    return _Span(name) if enabled else _NULL_SPAN
+
+def observe(name, seconds):
+    if not enabled:
+        return
+    with _lock:
+        stage = _stages.get(name)
+        if stage is None:
+            stage = _stages[name] = [0] * (len(BUCKETS) + 2) + [0.0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                stage[i] += 1
+                break
+        else:
+            stage[len(BUCKETS)] += 1
+        stage[-2] += 1
+        stage[-1] += seconds
+    trace = _current_trace.get()
+    if trace is not None:
+        trace["stages"].append((name, seconds))
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+    trace = _current_trace.get()
+    if trace is not None:
+        trace["counters"][name] = trace["counters"].get(name, 0) + n
+
+def start_trace(name):
+    # Collects the spans and counters of one request; None while metrics are disabled
+    if not enabled:
+        return None
+    return {"name": name, "time": time.time(), "started": time.perf_counter(), "stages": [], "counters": {}}
+
+class tracing:
+    # Binds a trace to the current thread or task. Gradio may run each step of a generator handler
+    # in a different context, so handlers bind around each step rather than once.
+    __slots__ = ("trace", "token")
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.token = _current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, *exc):
+        _current_trace.reset(self.token)
+        return False
+
+def end_trace(trace):
+    global last_trace
+    if trace is None:
+        return None
+    trace["total"] = time.perf_counter() - trace.pop("started")
+    last_trace = trace
+    _writer.submit(_append, json.dumps(trace, ensure_ascii=False))
+    return trace
+
+def _append(line):
+    # Runs on the writer thread
+    try:
+        if os.path.exists(metrics_path) and os.path.getsize(metrics_path) > MAX_FILE_BYTES:
+            os.replace(metrics_path, metrics_path + ".1")
+        with open(metrics_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except Exception as e:
+        print(f"[AIPI] Error writing metrics to {metrics_path}: {e}")
+
+def flush():
+    # Waits until every finished trace is in the file
+    _writer.submit(lambda: None).result()
+
+def prometheus_text():
+    lines = [
+        "# HELP aipi_stage_seconds Time spent in each stage of prompt generation.",
+        "# TYPE aipi_stage_seconds histogram",
+    ]
+    with _lock:
+        stages = {k: list(v) for k, v in _stages.items()}
+        counters = dict(_counters)
+    for name, stage in sorted(stages.items()):
+        cumulative = 0
+        for bound, n in zip(BUCKETS, stage):
+            cumulative += n
+            lines.append(f'aipi_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'aipi_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {stage[-2]}')
+        lines.append(f'aipi_stage_seconds_sum{{stage="{name}"}} {stage[-1]:.6f}')
+        lines.append(f'aipi_stage_seconds_count{{stage="{name}"}} {stage[-2]}')
+    for name, value in sorted(counters.items()):
+        lines.append(f"# TYPE aipi_{name}_total counter")
+        lines.append(f"aipi_{name}_total {value}")
+    return "\n".join(lines) + "\n"
+
+def snapshot():
+    # {"stages": {stage: {"count", "total"}}, "counters": {...}}
+    with _lock:
+        stages = {name: {"count": stage[-2], "total": stage[-1]} for name, stage in _stages.items()}
+        return {"stages": stages, "counters": dict(_counters)}
+
+def reset():
+    global last_trace
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+    last_trace = None
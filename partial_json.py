@@ -0,0 +1,99 @@
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+class PartialJsonFields:
+    # Pulls top-level string fields out of a JSON object while it is still being streamed.
+    # Each feed() only scans the new characters, so the total cost stays linear in the response size.
+    def __init__(self, fields):
+        self.fields = set(fields)
+        self.values = {}
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._unicode = None
+        self._high = None # A \uD800-\uDBFF escape waiting for the low half of its surrogate pair
+        self._expect_value = False
+        self._key = None
+        self._current = None
+        self._string_is_key = False
+
+    def feed(self, chunk):
+        changed = False
+        for ch in chunk:
+            if self._in_string:
+                if self._unicode is not None:
+                    self._unicode += ch
+                    if len(self._unicode) == 4:
+                        try:
+                            changed |= self._append_code(int(self._unicode, 16))
+                        except ValueError:
+                            pass
+                        self._unicode = None
+                elif self._escape:
+                    self._escape = False
+                    if ch == 'u':
+                        self._unicode = ""
+                    else:
+                        changed |= self._append(_ESCAPES.get(ch, ch))
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    changed |= self._flush_high()
+                    self._in_string = False
+                    if self._string_is_key:
+                        self._key = "".join(self._current)
+                    self._current = None
+                else:
+                    changed |= self._append(ch)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._current = []
+                # At the top level a string is a key unless it follows a colon
+                self._string_is_key = self._depth == 1 and not self._expect_value
+                if self._depth == 1 and self._expect_value and self._key in self.fields:
+                    self.values[self._key] = ""
+                    changed = True
+                self._expect_value = False
+            elif ch in '{[':
+                self._depth += 1
+                self._expect_value = False
+            elif ch in '}]':
+                self._depth -= 1
+            elif ch == ':' and self._depth == 1:
+                self._expect_value = True
+            elif ch == ',' and self._depth == 1:
+                self._key = None
+                self._expect_value = False
+        return changed
+
+    def _append_code(self, code):
+        # Characters outside the BMP arrive as a \uD8xx\uDCxx pair and are only appended once both halves are in
+        if 0xD800 <= code < 0xDC00:
+            changed = self._flush_high()
+            self._high = code
+            return changed
+        if 0xDC00 <= code < 0xE000:
+            if self._high is None:
+                return self._append("\ufffd")
+            high, self._high = self._high, None
+            return self._append(chr(0x10000 + ((high - 0xD800) << 10) + (code - 0xDC00)))
+        return self._append(chr(code))
+
+    def _flush_high(self):
+        # A high surrogate not followed by its low half is replaced, as a lenient decoder would
+        if self._high is None:
+            return False
+        self._high = None
+        return self._append("\ufffd")
+
+    def _append(self, text):
+        if self._high is not None:
+            # Anything but the low half ends a pending high surrogate
+            self._high = None
+            text = "\ufffd" + text
+        self._current.append(text)
+        if self._depth == 1 and not self._string_is_key and self._key in self.fields:
+            self.values[self._key] += text
+            return True
+        return False
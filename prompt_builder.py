@@ -0,0 +1,206 @@
+import json
+import re
+
+# Bump on any change to SYSTEM_PROMPT or the response schemas; stale cached responses are keyed out by it
+SYSTEM_PROMPT_VERSION = 3
+
+# Static prefix, sent first and byte-identical on every call, so the providers' prompt caches
+# (OpenAI prefix caching, Gemini cached content) can reuse it. Everything per request goes into user_prompt().
+SYSTEM_PROMPT = """You convert image requests, usually written in Japanese, into Stable Diffusion prompts (Positive and Negative).
+Return the result in JSON format with the following keys:
+- positive: The English positive prompt (comma-separated tags). IMPORTANT: Place all quality tags (e.g., masterpiece, best quality, ultra high res, etc.) at the very beginning of this list.
+- negative: The English negative prompt (comma-separated tags).
+- pos_mapping: A list of objects with "word" (English tag from positive) and "translation" (Japanese meaning).
+- neg_mapping: A list of objects with "word" (English tag from negative) and "translation" (Japanese meaning).
+When several variants are requested, return them as "variants", a list of objects that each have the keys above.
+Keep the subject of the request in every variant, but vary composition, camera angle, pose, expression, lighting, background and outfit between them.
+The response MUST be ONLY the JSON object."""
+
+def system_prompt(known_tags=None):
+    # known_tags: tags whose translation is already in the local dictionary; the model skips them
+    # in the mappings, which is most of the output tokens on long prompts. The list is a snapshot
+    # that changes rarely (see TagDictionary.prompt_tags), so it stays part of the cacheable prefix.
+    if not known_tags:
+        return SYSTEM_PROMPT
+    return f"""{SYSTEM_PROMPT}
+The mappings only need tags that are NOT in the following list (their translations are already known): {", ".join(known_tags)}
+Leave those tags out of pos_mapping and neg_mapping; they may still appear in positive and negative as usual."""
+
+def user_prompt(user_input, quality_tags=None, variants=1, variant_batch=0):
+    # The per-request suffix
+    lines = [f"Stable Diffusion で利用するプロンプトを生成してください。\n要望: {user_input}"]
+    if quality_tags:
+        lines.append(f"CRITICAL: Do not output any quality tags other than the following: {quality_tags}. Strictly follow this.")
+    if variants > 1:
+        lines.append(f"Generate {variants} clearly different variants and return them as \"variants\".")
+    if variant_batch:
+        # Parallel batches cannot see each other; steer each one away from the most obvious takes
+        lines.append(f"This is set #{variant_batch + 1} of several generated independently: avoid the most obvious interpretation and explore less common ones.")
+    return "\n".join(lines)
+
+# Shape every provider is asked to return; passed to the APIs as their native structured-output schema
+_MAPPING_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {"word": {"type": "string"}, "translation": {"type": "string"}},
+        "required": ["word", "translation"],
+        "additionalProperties": False,
+    },
+}
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "positive": {"type": "string"},
+        "negative": {"type": "string"},
+        "pos_mapping": _MAPPING_SCHEMA,
+        "neg_mapping": _MAPPING_SCHEMA,
+    },
+    "required": ["positive", "negative", "pos_mapping", "neg_mapping"],
+    "additionalProperties": False,
+}
+# Several pairs in one response; the count itself is only asked for in the prompt, since strict mode
+# does not accept minItems/maxItems everywhere
+RESPONSE_SCHEMA_VARIANTS = {
+    "type": "object",
+    "properties": {"variants": {"type": "array", "items": RESPONSE_SCHEMA}},
+    "required": ["variants"],
+    "additionalProperties": False,
+}
+
+def response_schema(variants=1):
+    return RESPONSE_SCHEMA_VARIANTS if variants > 1 else RESPONSE_SCHEMA
+
+def openai_response_format(mode, variants=1):
+    # mode: "json_schema" (OpenAI and xAI structured outputs), "json_object" or None
+    if mode == "json_schema":
+        name = "sd_prompt_variants" if variants > 1 else "sd_prompts"
+        return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": response_schema(variants)}}
+    if mode == "json_object":
+        return {"type": "json_object"}
+    return None
+
+def gemini_response_schema(schema=RESPONSE_SCHEMA):
+    # Gemini takes an OpenAPI subset: upper-case type names and no additionalProperties
+    converted = {}
+    for key, value in schema.items():
+        if key == "additionalProperties":
+            continue
+        if key == "type":
+            value = value.upper()
+        elif key == "properties":
+            value = {name: gemini_response_schema(prop) for name, prop in value.items()}
+        elif key == "items":
+            value = gemini_response_schema(value)
+        converted[key] = value
+    return converted
+
+# Parse error categories
+PARSE_EMPTY = "empty"
+PARSE_NO_JSON = "no_json"
+PARSE_INVALID_JSON = "invalid_json"
+PARSE_SCHEMA = "schema"
+
+class ResponseParseError(ValueError):
+    def __init__(self, category, detail):
+        super().__init__(f"{category}: {detail}")
+        self.category = category
+        self.detail = detail
+
+# Start of every parse error message; lets callers tell a malformed (often truncated) response from a failed call
+PARSE_ERROR_PREFIX = "Failed to parse the response"
+
+_decoder = json.JSONDecoder()
+_FENCE = re.compile(r"^```[a-zA-Z]*\s*|\s*```$")
+# Bounds the search for an object start when the model wrapped the JSON in prose
+MAX_OBJECT_STARTS = 8
+
+def _decode_object(text):
+    text = text.strip()
+    if not text:
+        raise ResponseParseError(PARSE_EMPTY, "empty response")
+    if text.startswith("```"):
+        text = _FENCE.sub("", text)
+    # Structured output returns the bare object, so the common case is a single json.loads
+    if text[0] == "{":
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+    # Otherwise decode from each "{" and stop at the end of the first complete object, ignoring trailing prose
+    start = text.find("{")
+    if start < 0:
+        raise ResponseParseError(PARSE_NO_JSON, "no JSON object in response")
+    last_error = None
+    for _ in range(MAX_OBJECT_STARTS):
+        try:
+            obj, _end = _decoder.raw_decode(text, start)
+            if isinstance(obj, dict):
+                return obj
+        except ValueError as e:
+            last_error = e
+        start = text.find("{", start + 1)
+        if start < 0:
+            break
+    raise ResponseParseError(PARSE_INVALID_JSON, str(last_error) if last_error else "no JSON object in response")
+
+def _tags(value, field):
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return ", ".join(v.strip() for v in value if v.strip())
+    raise ResponseParseError(PARSE_SCHEMA, f"'{field}' must be a string")
+
+def _mapping(value, field):
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ResponseParseError(PARSE_SCHEMA, f"'{field}' must be a list")
+    items = []
+    for item in value:
+        # Malformed entries only cost a translation line, not the whole response
+        if isinstance(item, dict) and isinstance(item.get("word"), str) and isinstance(item.get("translation"), str):
+            items.append({"word": item["word"], "translation": item["translation"]})
+    return items
+
+def _pair(obj):
+    if "positive" not in obj:
+        raise ResponseParseError(PARSE_SCHEMA, "missing 'positive'")
+    return {
+        "positive": _tags(obj["positive"], "positive"),
+        "negative": _tags(obj.get("negative", ""), "negative"),
+        "pos_mapping": _mapping(obj.get("pos_mapping"), "pos_mapping"),
+        "neg_mapping": _mapping(obj.get("neg_mapping"), "neg_mapping"),
+    }
+
+def _variants(obj):
+    items = obj.get("variants")
+    if items is None and "positive" in obj:
+        return [_pair(obj)] # The model answered with a single pair
+    if not isinstance(items, list):
+        raise ResponseParseError(PARSE_SCHEMA, "'variants' must be a list")
+    variants = []
+    for item in items:
+        # Like malformed mapping entries, one broken variant does not cost the others
+        try:
+            if isinstance(item, dict):
+                variants.append(_pair(item))
+        except ResponseParseError:
+            continue
+    if not variants:
+        raise ResponseParseError(PARSE_SCHEMA, "no valid variant")
+    return variants
+
+def parse_response(text, variants=1):
+    # Returns {"positive": str, "negative": str, "pos_mapping": [{"word", "translation"}], "neg_mapping": [...]},
+    # or {"variants": [such dicts]} when more than one variant was requested; raises ResponseParseError
+    obj = _decode_object(text or "")
+    if variants > 1:
+        return {"variants": _variants(obj)}
+    return _pair(obj)
+
+def parse_json_response(text, model_name, variants=1):
+    try:
+        return parse_response(text, variants), None
+    except ResponseParseError as e:
+        return None, f"{PARSE_ERROR_PREFIX} from {model_name} ({e.category}): {e.detail}"
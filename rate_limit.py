@@ -0,0 +1,224 @@
+import asyncio
+import contextlib
+import email.utils
+import hashlib
+import random
+import re
+import threading
+import time
+import metrics
+
+# Requests per minute and burst size per API key, by provider
+DEFAULT_RATE_LIMITS = {"gemini": (60, 10), "openai": (300, 20), "grok": (60, 10)}
+FALLBACK_RATE_LIMIT = (60, 10)
+
+# Total time a single generate request may spend including queueing and retries
+DEFAULT_DEADLINE_SECONDS = 90
+MAX_ATTEMPTS = 4
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8.0
+RETRY_AFTER_MAX_SECONDS = 60.0
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Cancelled(Exception):
+    pass
+
+def _sleep(seconds, cancel_event=None):
+    if cancel_event is None:
+        time.sleep(seconds)
+    elif cancel_event.wait(seconds):
+        raise Cancelled("Request was cancelled.")
+
+class TokenBucket:
+    def __init__(self, per_minute, burst):
+        self.set_rate(per_minute, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def set_rate(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.burst = max(1, burst if burst is not None else getattr(self, "burst", 1))
+
+    def pause(self, seconds):
+        # A 429 applies to the key, so every caller sharing the bucket backs off together
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+    def _reserve(self):
+        # Takes a token and returns 0, or returns how long to wait before trying again
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = self._paused_until - now
+            if wait <= 0:
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return 0.0
+                wait = (1 - self._tokens) / self.rate if self.rate > 0 else BACKOFF_MAX_SECONDS
+            return wait
+
+    def acquire(self, deadline=None, cancel_event=None):
+        while True:
+            wait = self._reserve()
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            _sleep(wait, cancel_event)
+
+    async def acquire_async(self, deadline=None):
+        # Same as acquire(), but waits without blocking the event loop; cancelled with its task
+        while True:
+            wait = self._reserve()
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def _bucket_key(provider, api_key):
+    return provider, hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+def get_bucket(provider, api_key):
+    key = _bucket_key(provider, api_key)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(*DEFAULT_RATE_LIMITS.get(provider, FALLBACK_RATE_LIMIT))
+            _buckets[key] = bucket
+        return bucket
+
+def set_rate_limit(provider, api_key, per_minute, burst=None):
+    get_bucket(provider, api_key).set_rate(per_minute, burst)
+
+@contextlib.contextmanager
+def temporary_rate_limit(provider, api_key, per_minute, burst=None):
+    # The key's bucket runs at per_minute inside the with block and gets its previous rate back afterwards
+    bucket = get_bucket(provider, api_key)
+    previous = bucket.rate * 60.0, bucket.burst
+    bucket.set_rate(per_minute, burst)
+    try:
+        yield bucket
+    finally:
+        bucket.set_rate(*previous)
+
+def make_deadline(seconds=DEFAULT_DEADLINE_SECONDS):
+    return time.monotonic() + seconds
+
+def remaining(deadline, minimum=1.0):
+    # Seconds left for a network call, for the SDKs' own timeout arguments
+    if deadline is None:
+        return None
+    return max(minimum, deadline - time.monotonic())
+
+def status_of(error):
+    for attr in ("status_code", "code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    name = type(error).__name__
+    if "Timeout" in name or "Connection" in name or "Unavailable" in name:
+        return 503
+    match = re.search(r"\b(408|429|500|502|503|504)\b", str(error))
+    return int(match.group(1)) if match else None
+
+def retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        value = headers.get("retry-after-ms")
+        if value:
+            try:
+                return min(float(value) / 1000.0, RETRY_AFTER_MAX_SECONDS)
+            except ValueError:
+                pass
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return min(float(value), RETRY_AFTER_MAX_SECONDS)
+            except ValueError:
+                try:
+                    parsed = email.utils.parsedate_to_datetime(value)
+                    return min(max(0.0, parsed.timestamp() - time.time()), RETRY_AFTER_MAX_SECONDS)
+                except (TypeError, ValueError):
+                    pass
+    # Gemini puts the delay in the error details instead of a header
+    match = re.search(r"retry in ([\d.]+)s|retry_delay\s*\{\s*seconds:\s*(\d+)", str(error))
+    if match:
+        return min(float(match.group(1) or match.group(2)), RETRY_AFTER_MAX_SECONDS)
+    return None
+
+def backoff(attempt):
+    # Full jitter keeps callers that failed together from retrying together
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+def call_with_retry(provider, api_key, fn, deadline=None, cancel_event=None, max_attempts=MAX_ATTEMPTS):
+    # cancel_event stops the request while it is queued or backing off
+    bucket = get_bucket(provider, api_key)
+    attempt = 0
+    while True:
+        if cancel_event is not None and cancel_event.is_set():
+            raise Cancelled("Request was cancelled.")
+        with metrics.span("rate_limit_wait"):
+            acquired = bucket.acquire(deadline, cancel_event)
+        if not acquired:
+            raise DeadlineExceeded(f"Deadline exceeded while waiting for the {provider} rate limit.")
+        try:
+            with metrics.span("network"):
+                return fn()
+        except Exception as e:
+            attempt += 1
+            delay = _retry_delay(provider, bucket, e, attempt, deadline, max_attempts)
+            if delay is None:
+                raise
+            if delay > 0:
+                _sleep(delay, cancel_event)
+
+async def call_with_retry_async(provider, api_key, fn, deadline=None, max_attempts=MAX_ATTEMPTS):
+    # fn() returns an awaitable. Cancelling the calling task aborts the request in flight.
+    bucket = get_bucket(provider, api_key)
+    attempt = 0
+    while True:
+        with metrics.span("rate_limit_wait"):
+            acquired = await bucket.acquire_async(deadline)
+        if not acquired:
+            raise DeadlineExceeded(f"Deadline exceeded while waiting for the {provider} rate limit.")
+        try:
+            with metrics.span("network"):
+                return await fn()
+        except Exception as e:
+            attempt += 1
+            delay = _retry_delay(provider, bucket, e, attempt, deadline, max_attempts)
+            if delay is None:
+                raise
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+def _retry_delay(provider, bucket, error, attempt, deadline, max_attempts):
+    # Seconds to sleep before the next attempt (0 when the bucket pause covers it), or None to give up
+    status = status_of(error)
+    if status not in RETRYABLE_STATUS or attempt >= max_attempts:
+        return None
+    delay = retry_after(error)
+    if delay is None:
+        delay = backoff(attempt)
+    if deadline is not None and time.monotonic() + delay > deadline:
+        return None
+    metrics.count("retries")
+    print(f"[AIPI] {provider} returned {status}, retrying in {delay:.1f}s (attempt {attempt + 1}/{max_attempts})")
+    if status == 429:
+        # The next acquire() waits out the pause
+        bucket.pause(delay)
+        return 0.0
+    return delay
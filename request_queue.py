@@ -0,0 +1,48 @@
+import asyncio
+
+# How often a waiting caller re-checks its position
+POSITION_POLL_SECONDS = 0.5
+
+class AsyncRequestQueue:
+    # First-come, first-served limit on concurrent requests for async handlers.
+    # Runs on the event loop only, so no locking is needed.
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._waiters = [] # Futures in arrival order; resolved when a slot is handed over
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    async def enter(self):
+        # Async generator yielding the 1-based queue position whenever it changes (nothing when a slot
+        # is free right away). When it finishes the caller holds a slot and must call leave().
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            position = None
+            while not waiter.done():
+                current = self._waiters.index(waiter) + 1
+                if current != position:
+                    position = current
+                    yield position
+                await asyncio.wait([waiter], timeout=POSITION_POLL_SECONDS)
+        except BaseException:
+            # Cancelled or abandoned while queued
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.done():
+                self.leave() # The slot was already handed over; pass it on
+            raise
+
+    def leave(self):
+        while self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None) # The slot moves to the next caller, so active stays the same
+                return
+        self.active -= 1
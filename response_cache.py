@@ -0,0 +1,169 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+cache_path = os.path.join(base_dir, "response_cache.sqlite3")
+
+# Eviction limits
+MEMORY_MAX_ENTRIES = 256
+DISK_MAX_ENTRIES = 2000
+TTL_SECONDS = 7 * 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    model TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_created ON responses (created);
+"""
+
+def normalize_text(text):
+    # Full-width/half-width and whitespace differences should not produce new cache entries
+    text = unicodedata.normalize("NFKC", text or "")
+    return " ".join(text.split())
+
+def make_key(llm_type, model, user_input, quality_tags, template_version, variants=None):
+    # variants: (count, batch) for multi-variant requests; single requests keep their existing keys
+    parts = [llm_type, model, normalize_text(user_input), normalize_text(quality_tags), template_version]
+    if variants is not None:
+        parts.append(list(variants))
+    raw = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    # Recent responses in memory, all of them in SQLite. Writes are queued to a single writer thread,
+    # so put() never waits on the disk; get() only touches the disk on a memory miss.
+    def __init__(self, path, memory_max=MEMORY_MAX_ENTRIES, disk_max=DISK_MAX_ENTRIES, ttl=TTL_SECONDS):
+        self.path = path
+        self.memory_max = memory_max
+        self.disk_max = disk_max
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._disk_entries = 0
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aipi-cache-writer")
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    def _connect(self):
+        # Caller must hold the db lock
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+            self._disk_entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return self._db
+
+    def _trim(self, db):
+        # Caller must hold the db lock
+        db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        excess = db.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.disk_max
+        if excess > 0:
+            db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created LIMIT ?)", (excess,))
+
+    def _read(self, key):
+        with self._db_lock:
+            try:
+                row = self._connect().execute("SELECT created, model, data FROM responses WHERE key = ?", (key,)).fetchone()
+            except Exception as e:
+                print(f"[AIPI] Error reading response cache from {self.path}: {e}")
+                return None
+        if row is None or time.time() - row[0] >= self.ttl:
+            return None
+        return {"data": json.loads(row[2]), "model": row[1], "created": row[0]}
+
+    def _write(self, key, entry):
+        # Runs on the writer thread
+        with self._db_lock:
+            try:
+                db = self._connect()
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (key, created, model, data) VALUES (?, ?, ?, ?)",
+                    (key, entry["created"], entry["model"], json.dumps(entry["data"], ensure_ascii=False)),
+                )
+                self._trim(db)
+                db.commit()
+                self._disk_entries = db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            except Exception as e:
+                print(f"[AIPI] Error saving response cache to {self.path}: {e}")
+
+    def _clear(self):
+        with self._db_lock:
+            try:
+                db = self._connect()
+                db.execute("DELETE FROM responses")
+                db.commit()
+                self._disk_entries = 0
+            except Exception as e:
+                print(f"[AIPI] Error clearing response cache at {self.path}: {e}")
+
+    def _remember(self, key, entry):
+        # Caller must hold the lock
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_max:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        # Reads the disk on a memory miss; async callers should run this in a worker thread
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if time.time() - entry["created"] < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits_memory += 1
+                    return copy.deepcopy(entry["data"])
+                del self._memory[key]
+
+        entry = self._read(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remember(key, entry)
+            self.hits_disk += 1
+            return copy.deepcopy(entry["data"])
+
+    def put(self, key, data, model=None):
+        entry = {"data": copy.deepcopy(data), "model": model, "created": time.time()}
+        with self._lock:
+            self._remember(key, entry)
+        self._writer.submit(self._write, key, entry)
+
+    def flush(self):
+        # Waits until every queued write is on disk
+        self._writer.submit(lambda: None).result()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        # Queued behind pending writes, so none of them survives the clear
+        self._writer.submit(self._clear).result()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits_memory + self.hits_disk + self.misses
+            return {
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": (self.hits_memory + self.hits_disk) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": self._disk_entries,
+            }
+
+response_cache = ResponseCache(cache_path)
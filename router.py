@@ -0,0 +1,128 @@
+import atexit
+import copy
+import json
+import os
+import threading
+import time
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+stats_path = os.path.join(base_dir, "router_stats.json")
+
+ALPHA = 0.2
+# Latency assumed for a model that has never been measured, so new models still get tried
+PRIOR_LATENCY = 5.0
+# Above this error rate a model is considered unhealthy and only used when nothing else is left
+UNHEALTHY_ERROR_RATE = 0.5
+# An unhealthy model gets another chance once it has not been tried for this long
+RECOVERY_SECONDS = 10 * 60
+# record() only updates memory; the file is rewritten at most this often, from a timer thread
+SAVE_INTERVAL_SECONDS = 5.0
+
+class ModelRouter:
+    def __init__(self, path):
+        self.path = path
+        self._stats = None
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock() # Serializes file writes without blocking record()/choose()
+        self._dirty = False
+        self._timer = None
+        self.last_decision = None
+
+    def _load(self):
+        # Caller must hold the lock
+        if self._stats is not None:
+            return
+        self._stats = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._stats = json.load(f) or {}
+            except Exception as e:
+                print(f"[AIPI] Error loading router stats from {self.path}: {e}")
+
+    def _schedule(self):
+        # Caller must hold the lock
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(SAVE_INTERVAL_SECONDS, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _write(self, stats):
+        # Caller must hold the save lock
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(stats, f, indent=4, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"[AIPI] Error saving router stats to {self.path}: {e}")
+
+    def record(self, provider, model, latency, outcome):
+        # outcome: "ok", "error", "rate_limited" or "parse_error"
+        key = f"{provider}/{model}"
+        with self._lock:
+            self._load()
+            s = self._stats.get(key)
+            if s is None:
+                s = {"provider": provider, "model": model, "latency": latency, "error_rate": 0.0, "rate_limit_rate": 0.0, "parse_failure_rate": 0.0, "samples": 0}
+                self._stats[key] = s
+            # Failed calls say little about normal latency, so only successful ones move it
+            if outcome in ("ok", "parse_error"):
+                s["latency"] = latency if s["samples"] == 0 else (1 - ALPHA) * s["latency"] + ALPHA * latency
+            s["error_rate"] = (1 - ALPHA) * s["error_rate"] + ALPHA * (outcome in ("error", "rate_limited"))
+            s["rate_limit_rate"] = (1 - ALPHA) * s["rate_limit_rate"] + ALPHA * (outcome == "rate_limited")
+            s["parse_failure_rate"] = (1 - ALPHA) * s["parse_failure_rate"] + ALPHA * (outcome == "parse_error")
+            s["samples"] += 1
+            s["updated"] = time.time()
+            self._schedule()
+
+    def _score(self, s):
+        if s is None:
+            return PRIOR_LATENCY
+        # Expected time to a usable answer: failures and unparsable output mean another round trip
+        return s["latency"] * (1 + 2 * s["error_rate"] + 2 * s["parse_failure_rate"])
+
+    def choose(self, candidates):
+        # candidates: list of (llm_type, provider, model); returns the chosen tuple or None
+        if not candidates:
+            return None
+        with self._lock:
+            self._load()
+            now = time.time()
+            scored = []
+            for llm_type, provider, model in candidates:
+                s = self._stats.get(f"{provider}/{model}")
+                healthy = s is None or s["error_rate"] < UNHEALTHY_ERROR_RATE or now - s.get("updated", 0) > RECOVERY_SECONDS
+                scored.append((not healthy, self._score(s), (llm_type, provider, model), s))
+            scored.sort(key=lambda x: (x[0], x[1]))
+            unhealthy, score, choice, s = scored[0]
+            if s is None:
+                reason = f"{choice[2]}: 未計測のため試行 (想定 {score:.1f}s)"
+            else:
+                reason = f"{choice[2]}: スコア {score:.2f}s (平均 {s['latency']:.2f}s, エラー率 {s['error_rate']:.0%}, パース失敗率 {s['parse_failure_rate']:.0%})"
+            if unhealthy:
+                reason += " ※全モデルが不調のため最良のものを使用"
+            self.last_decision = {"choice": choice, "reason": reason, "alternatives": [(c, sc, u) for u, sc, c, _ in scored[1:]], "time": now}
+            return choice
+
+    def snapshot(self):
+        with self._lock:
+            self._load()
+            rows = [dict(s, score=self._score(s)) for s in self._stats.values()]
+        return sorted(rows, key=lambda r: r["score"])
+
+    def flush(self):
+        with self._save_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                stats = copy.deepcopy(self._stats)
+            self._write(stats)
+
+model_router = ModelRouter(stats_path)
+atexit.register(model_router.flush)
@@ -1,8 +1,24 @@
+import time
+_import_started = time.perf_counter()
+
 import modules.script_callbacks as script_callbacks
 import gradio as gr
-import json
+import asyncio
+import html
 import os
-from llm_api import generate_prompts
+import threading
+from llm_api import generate_prompts_async, generate_prompts_stream_async, generate_variants_async, cancel_session, generate_queue, MAX_VARIANTS, get_cache_stats, get_dictionary_stats, get_usage_stats, get_router_stats, AUTO_LLM
+from tag_pipeline import apply_prompt_settings
+from tag_dictionary import tag_key
+from batch import iter_batch
+from singleflight import SUPERSEDED_ERROR
+from llm_providers import providers
+from config_store import get_store
+from history_store import history_store, make_settings_key
+import metrics
+
+# What this extension adds to webui launch; provider SDKs are not imported until first use
+startup_timings = {"import": time.perf_counter() - _import_started}
 
 # Path for config files
 script_path = os.path.abspath(__file__)
@@ -14,47 +30,28 @@ print(f"[AIPI] Base Directory: {base_dir}")
 print(f"[AIPI] Config Path: {config_path}")
 print(f"[AIPI] Presets Path: {presets_path}")
 
-def load_json(path):
-    abs_path = os.path.abspath(path)
-    if os.path.exists(abs_path):
-        try:
-            with open(abs_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                return data if data else {}
-        except Exception as e:
-            print(f"[AIPI] Error loading JSON from {abs_path}: {e}")
-    return {}
-
-def save_json(path, data):
-    try:
-        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except Exception as e:
-        print(f"[AIPI] Error saving JSON to {path}: {e}")
+config_store = get_store(config_path)
+presets_store = get_store(presets_path)
 
 def load_config():
-    return load_json(config_path)
+    return config_store.get()
 
-def save_config(llm_type, gemini_key, openai_key, grok_key, prompt_settings_enabled, quality_tags_enabled, quality_tags_preset, bottom_mandatory_enabled, bottom_mandatory_preset, user_input):
-    config = load_config()
-    config.update({
-        "llm_type": llm_type,
-        "gemini_key": gemini_key,
-        "openai_key": openai_key,
-        "grok_key": grok_key,
-        "prompt_settings_enabled": prompt_settings_enabled,
-        "quality_tags_enabled": quality_tags_enabled,
-        "quality_tags_preset": quality_tags_preset,
-        "bottom_mandatory_enabled": bottom_mandatory_enabled,
-        "bottom_mandatory_preset": bottom_mandatory_preset,
-        "user_input": user_input
-    })
-    save_json(config_path, config)
+def load_presets():
+    return presets_store.get()
+
+def save_setting(key, value):
+    # Each setting is saved on its own, so a session only writes what it changed and never overwrites
+    # another session's other settings; the file itself is written once typing pauses
+    config_store.update({key: value})
+
+def save_presets(category, entries):
+    # Preset edits are explicit actions, so they are written right away
+    presets_store.update({category: entries}, delay=False)
 
 def on_ui_tabs():
+    ui_started = time.perf_counter()
     config = load_config()
-    presets = load_json(presets_path)
+    presets = load_presets()
     if "quality_tags" not in presets: presets["quality_tags"] = {}
     if "bottom_mandatory" not in presets: presets["bottom_mandatory"] = {}
 
@@ -77,15 +74,24 @@ def on_ui_tabs():
             with gr.Group(elem_id="aipi_llm_settings_group"):
                 gr.Markdown("### LLM設定")
                 with gr.Row():
-                    llm_type = gr.Dropdown(choices=["Gemini 3.0", "Gemini 2.0", "ChatGPT", "Grok"], value=config.get("llm_type", "Gemini 3.0"), label="LLM選択", scale=1)
-                    gemini_key = gr.Textbox(value=config.get("gemini_key", ""), label="API Key (Gemini)", type="password", visible=("Gemini" in config.get("llm_type", "Gemini 3.0")), scale=2)
-                    openai_key = gr.Textbox(value=config.get("openai_key", ""), label="API Key (ChatGPT)", type="password", visible=(config.get("llm_type") == "ChatGPT"), scale=2)
-                    grok_key = gr.Textbox(value=config.get("grok_key", ""), label="API Key (Grok)", type="password", visible=(config.get("llm_type") == "Grok"), scale=2)
+                    llm_type = gr.Dropdown(choices=["Gemini 3.0", "Gemini 2.0", "ChatGPT", "Grok", AUTO_LLM], value=config.get("llm_type", "Gemini 3.0"), label="LLM選択", scale=1)
+                    is_auto = config.get("llm_type") == AUTO_LLM
+                    gemini_key = gr.Textbox(value=config.get("gemini_key", ""), label="API Key (Gemini)", type="password", visible=(is_auto or "Gemini" in config.get("llm_type", "Gemini 3.0")), scale=2)
+                    openai_key = gr.Textbox(value=config.get("openai_key", ""), label="API Key (ChatGPT)", type="password", visible=(is_auto or config.get("llm_type") == "ChatGPT"), scale=2)
+                    grok_key = gr.Textbox(value=config.get("grok_key", ""), label="API Key (Grok)", type="password", visible=(is_auto or config.get("llm_type") == "Grok"), scale=2)
+                with gr.Row():
+                    race_enabled = gr.Checkbox(value=False, label="レースモード", scale=0)
+                    race_hedge_delay = gr.Slider(minimum=0, maximum=10, step=0.5, value=2, label="追加リクエストまでの待ち時間 (秒, 0 = 同時送信)")
+                    race_max_extra = gr.Slider(minimum=1, maximum=3, step=1, value=1, label="追加リクエストの上限数")
+                gr.Markdown("<small>APIキーが設定されている他のLLMにも同じ要望を送り、最初に返った結果を使います。レースモード中はストリーミング表示されません。</small>", elem_classes="aipi_description")
 
 
 
             with gr.Row():
                 user_input = gr.Textbox(value=config.get("user_input", ""), label="Input prompt (Japanese)", placeholder="日本語で要求を入力してください...", lines=3)
+            # Earlier requests close to the one being typed; selecting a row loads its result without calling the LLM
+            similar_table = gr.Dataframe(headers=["類似度", "要望", "Positive", "日時"], datatype=["str", "str", "str", "str"], interactive=False, wrap=True, visible=False, label="似た要望の履歴 (クリックで結果を読み込み)")
+            similar_ids = gr.State([])
 
 
         # Modal logic
@@ -94,7 +100,14 @@ def on_ui_tabs():
         
         with gr.Row():
             generate_btn = gr.Button("Generate", variant="primary")
+            cancel_btn = gr.Button("Cancel", variant="stop", scale=0)
             both_send_btn = gr.Button("Send Both to txt2img", variant="secondary", elem_id="gemini_both_send")
+        with gr.Row():
+            streaming = gr.Checkbox(value=True, label="ストリーミング表示", scale=0)
+            bypass_cache = gr.Checkbox(value=False, label="キャッシュを使用しない", scale=0)
+            replace_pending = gr.Checkbox(value=True, label="再クリック時は前のリクエストを取り消す", scale=0)
+            variants_count = gr.Slider(minimum=1, maximum=MAX_VARIANTS, step=1, value=1, label="バリエーション数", scale=1)
+            cache_status = gr.Markdown("", elem_id="aipi_cache_status")
         
         error_display = gr.HTML(visible=False)
         
@@ -113,6 +126,9 @@ def on_ui_tabs():
                 gr.Markdown("### 日本語訳 (Negative)")
                 neg_translation_display = gr.HTML(elem_id="gemini_neg_translation_display")
 
+        # One row per variant when バリエーション数 > 1; sending is handled in javascript/script.js
+        variants_display = gr.HTML(visible=False, elem_id="aipi_variants_display")
+
         # Prompt Settings Accordion with integrated checkbox (ADetailer style)
         with gr.Row(elem_classes="aipi_accordion_header"):
             prompt_settings_enabled = gr.Checkbox(value=config.get("prompt_settings_enabled", False), label="", scale=0, elem_id="aipi_prompt_settings_checkbox")
@@ -135,95 +151,268 @@ def on_ui_tabs():
                     bottom_mandatory_edit_btn = gr.Button("🖌️", elem_id="aipi_bottom_mandatory_edit_btn", elem_classes="aipi_edit_btn")
                 bottom_mandatory_prompt = gr.Textbox(value=presets.get("bottom_mandatory", {}).get(config.get("bottom_mandatory_preset", ""), ""), label="最下部タグ", placeholder="最下部タグを入力...", lines=2, interactive=True)
 
-        def on_generate(llm, g_key, o_key, gr_key, prompt_settings_enabled, quality_tags_enabled, quality_tags_preset, bottom_mandatory_enabled, bottom_mandatory_preset, text, qt_prompt, bm_prompt):
-            # Save settings (saving presets names)
-            save_config(llm, g_key, o_key, gr_key, prompt_settings_enabled, quality_tags_enabled, quality_tags_preset, bottom_mandatory_enabled, bottom_mandatory_preset, text)
+        # Router statistics for the Auto option
+        with gr.Accordion("ルーター統計 (Auto)", open=False, elem_id="aipi_router_accordion"):
+            router_stats_display = gr.HTML()
+            router_refresh_btn = gr.Button("🔄 更新", scale=0)
+
+        # Per-stage timings of the last Generate (also exported at /aipi/metrics)
+        with gr.Accordion("タイミング", open=False, elem_id="aipi_timings_accordion"):
+            metrics_enabled = gr.Checkbox(value=metrics.enabled, label="計測を有効にする")
+            timings_display = gr.HTML()
+
+        # Generation history (history.sqlite3)
+        with gr.Accordion("履歴", open=False, elem_id="aipi_history_accordion"):
+            with gr.Row():
+                history_search = gr.Textbox(label="検索", placeholder="要望の一部を入力...", scale=3)
+                history_refresh_btn = gr.Button("🔄 更新", scale=0)
+            history_table = gr.Dataframe(headers=["日時", "要望", "Positive", "LLM"], datatype=["str", "str", "str", "str"], interactive=False, wrap=True, label="クリックで結果を読み込み")
+            history_ids = gr.State([])
+
+        # Batch Generation (JSONL in, JSONL out)
+        with gr.Accordion("バッチ生成", open=False, elem_id="aipi_batch_accordion"):
+            gr.Markdown("<small>JSONLの各行の要望からプロンプトを生成し、結果をJSONLに追記します。中断しても同じ出力ファイルを指定すれば続きから再開します。</small>", elem_classes="aipi_description")
+            with gr.Row():
+                batch_input_path = gr.Textbox(value=os.path.join(base_dir, "batch_input.jsonl"), label="入力JSONL", scale=3)
+                batch_output_path = gr.Textbox(value=os.path.join(base_dir, "batch_output.jsonl"), label="出力JSONL", scale=3)
+            with gr.Row():
+                batch_workers = gr.Slider(minimum=1, maximum=16, step=1, value=4, label="同時実行数")
+                batch_rpm = gr.Number(value=0, label="1分あたりの最大リクエスト数 (0 = プロバイダ既定値)", precision=0)
+            with gr.Row():
+                batch_run_btn = gr.Button("バッチ実行", variant="primary")
+            batch_status = gr.Markdown("")
+
+        def format_cache_stats():
+            stats = get_cache_stats()
+            hits = stats["hits_memory"] + stats["hits_disk"]
+            dictionary = get_dictionary_stats()
+            html = (f"<small>キャッシュ: ヒット {hits} (メモリ {stats['hits_memory']} / ディスク {stats['hits_disk']}) / ミス {stats['misses']} / 保存件数 {stats['disk_entries']}"
+                    f" ｜ タグ辞書: {dictionary['entries']}語 / ヒット率 {dictionary['hit_rate']:.0%} / 削減した出力トークン 約{dictionary['tokens_saved']}"
+                    f" ｜ 履歴: {history_store.stats()['entries']}件")
+            usage = get_usage_stats()
+            prompt_tokens = sum(u["prompt_tokens"] for u in usage.values())
+            if prompt_tokens:
+                # Share of the prompt served from the providers' prompt caches (cheaper and faster to the first token)
+                cached_tokens = sum(u["cached_tokens"] for u in usage.values())
+                html += f" ｜ プロンプトキャッシュ: {cached_tokens}/{prompt_tokens} トークン ({cached_tokens / prompt_tokens:.0%})"
+            return html + "</small>"
+
+        def format_router_stats():
+            rows, decision = get_router_stats()
+            html = ""
+            if decision:
+                html += f"<p><b>直近の選択:</b> {decision['reason']}</p>"
+            if not rows:
+                return html + "<p><small>まだ計測データがありません。</small></p>"
+            html += "<table class='aipi_router_table'><tr><th>Provider</th><th>Model</th><th>スコア</th><th>平均レイテンシ</th><th>エラー率</th><th>429率</th><th>パース失敗率</th><th>件数</th></tr>"
+            for r in rows:
+                html += f"<tr><td>{r['provider']}</td><td>{r['model']}</td><td>{r['score']:.2f}s</td><td>{r['latency']:.2f}s</td><td>{r['error_rate']:.0%}</td><td>{r['rate_limit_rate']:.0%}</td><td>{r['parse_failure_rate']:.0%}</td><td>{r['samples']}</td></tr>"
+            return html + "</table>"
+
+        def format_timings():
+            trace = metrics.last_trace
+            if not metrics.enabled:
+                return "<p><small>計測は無効です。</small></p>"
+            if trace is None:
+                return "<p><small>まだ計測データがありません。</small></p>"
+            html = f"<p><b>合計:</b> {trace['total'] * 1000:.1f} ms</p><table class='aipi_router_table'><tr><th>ステージ</th><th>時間</th></tr>"
+            for name, seconds in trace["stages"]:
+                html += f"<tr><td>{name}</td><td>{seconds * 1000:.1f} ms</td></tr>"
+            html += "</table>"
+            if trace["counters"]:
+                html += "<p><small>" + " / ".join(f"{k}: {v}" for k, v in trace["counters"].items()) + "</small></p>"
+            return html
+
+        def race_candidates(llm, g_key, o_key, gr_key):
+            # Other providers with a configured key, fastest Gemini line-up first
+            candidates = [("Gemini 2.0", g_key), ("ChatGPT", o_key), ("Grok", gr_key)]
+            return [(t, k) for t, k in candidates if k and not ("Gemini" in t and "Gemini" in llm)]
+
+        async def on_generate(llm, g_key, o_key, gr_key, prompt_settings_enabled, quality_tags_enabled, quality_tags_preset, bottom_mandatory_enabled, bottom_mandatory_preset, text, qt_prompt, bm_prompt, bypass, streaming, race, hedge_delay, max_extra, replace, variants, request: gr.Request):
+            # Runs on the event loop, so waiting on a slow provider does not hold one of the webui's worker threads
+            # The other settings were saved as they changed; the request text may have been filled in from history.
+            # The store may re-read the file, so this stays off the event loop.
+            await asyncio.to_thread(save_setting, "user_input", text)
 
             api_key = g_key if "Gemini" in llm else (o_key if llm == "ChatGPT" else gr_key)
+            api_keys = {"gemini": g_key, "openai": o_key, "grok": gr_key}
+            session_id = request.session_hash if (replace and request is not None) else None
             
             # Pass quality tags constraint to LLM if enabled (using the actual textbox content)
-            data, error = generate_prompts(llm, api_key, text, quality_tags=(qt_prompt if (prompt_settings_enabled and quality_tags_enabled) else None))
+            quality_tags = qt_prompt if (prompt_settings_enabled and quality_tags_enabled) else None
+            variants = int(variants)
+            settings_key = make_settings_key(llm, quality_tags, variants)
+
+            if not bypass:
+                # The same request (ignoring spacing, punctuation and width) with the same settings was answered before
+                # The first lookup waits for the history index to be built, so it runs off the event loop
+                entry = await asyncio.to_thread(history_store.find, text, settings_key)
+                if entry is not None:
+                    outputs = finish_generate(entry["result"], None, prompt_settings_enabled, quality_tags_enabled, bottom_mandatory_enabled, qt_prompt, bm_prompt)
+                    yield (*outputs[:5], gr.update(value=f"<small>履歴 ({format_time(entry['created'])}) の結果を再利用しました。新しく生成するには「キャッシュを使用しない」をオンにしてください。</small>"), outputs[6])
+                    return
+
+            queue = generate_queue.enter()
+            try:
+                async for position in queue:
+                    yield gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update(value=f"<small>待機中: {position}番目 (同時実行数 {generate_queue.limit})</small>"), gr.update()
+            finally:
+                # Gives the place in line back when cancelled while waiting
+                await queue.aclose()
+
+            # Gradio may resume this generator in another context, so the trace is bound around each step
+            trace = metrics.start_trace("generate")
+            try:
+                if variants > 1:
+                    # Variants come back as one structured response (or parallel batches), so they are not streamed
+                    with metrics.tracing(trace):
+                        data, error = await generate_variants_async(llm, api_key, text, variants, use_cache=not bypass, race_with=(race_candidates(llm, g_key, o_key, gr_key) if race else None), hedge_delay=hedge_delay, max_extra=max_extra, api_keys=api_keys, session_id=session_id, quality_tags=quality_tags)
+                elif race or not streaming:
+                    with metrics.tracing(trace):
+                        data, error = await generate_prompts_async(llm, api_key, text, use_cache=not bypass, race_with=(race_candidates(llm, g_key, o_key, gr_key) if race else None), hedge_delay=hedge_delay, max_extra=max_extra, api_keys=api_keys, session_id=session_id, quality_tags=quality_tags)
+                else:
+                    data, error = None, None
+                    stream = generate_prompts_stream_async(llm, api_key, text, use_cache=not bypass, api_keys=api_keys, session_id=session_id, quality_tags=quality_tags)
+                    try:
+                        while True:
+                            with metrics.tracing(trace):
+                                kind, value = await anext(stream, (None, None))
+                            if kind == "partial":
+                                # Raw tags as they arrive; post-processing runs once the stream completes
+                                yield gr.update(visible=False, value=""), gr.update(value=value.get("positive", "")), gr.update(value=value.get("negative", "")), gr.update(value=""), gr.update(value=""), gr.update(value=""), gr.update(visible=False, value="")
+                            elif kind == "result":
+                                data, error = value
+                            else:
+                                break
+                    finally:
+                        # Also runs on Cancel, which aborts the HTTP response
+                        await stream.aclose()
+            finally:
+                generate_queue.leave()
+
+            if data is not None and not error:
+                # Off the event loop: the insert waits for SQLite to commit
+                settings = {"llm_type": llm, "quality_tags": quality_tags, "variants": variants}
+                await asyncio.to_thread(history_store.add, text, settings, data, settings_key)
             
+            with metrics.tracing(trace):
+                outputs = finish_generate(data, error, prompt_settings_enabled, quality_tags_enabled, bottom_mandatory_enabled, qt_prompt, bm_prompt)
+            metrics.end_trace(trace)
+            yield outputs
+
+        async def on_cancel(request: gr.Request):
+            # Gradio cancels the running handler; this also stops work that is not awaited by it (race threads)
+            if request is not None:
+                cancel_session(request.session_hash)
+
+        def finish_generate(data, error, prompt_settings_enabled, quality_tags_enabled, bottom_mandatory_enabled, qt_prompt, bm_prompt):
+            if error == SUPERSEDED_ERROR:
+                # A newer click from this session owns the outputs now
+                return gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
             if error:
                 error_html = f"<div style='color: red; padding: 10px; border: 1px solid red; border-radius: 5px;'>{error}</div>"
-                return gr.update(visible=True, value=error_html), gr.update(), gr.update(), gr.update(value=""), gr.update(value="")
-            
-            pos = data.get("positive", "")
-            neg = data.get("negative", "")
-            
-            # Apply Prompt Settings only if master toggle is enabled
-            if prompt_settings_enabled:
-                # 1. Quality Tags filtering (Final client-side check)
-                if quality_tags_enabled and qt_prompt:
-                    input_quality_tags = [t.strip() for t in qt_prompt.split(",") if t.strip()]
-                    common_quality_tags = ["masterpiece", "best quality", "ultra high res", "highres", "extremely detailed", "8k", "4k"]
-                    pos_tags = [t.strip() for t in pos.split(",")]
-                    filtered_tags = []
-                    quality_tags_to_prepend = []
-
-                    filtered_tags = []
-                    quality_tags_to_prepend = []
-
-                    # Identify quality tags to keep
-                    for t in pos_tags:
-                        t_lower = t.lower()
-                        is_quality = any(q in t_lower for q in common_quality_tags)
-                        if is_quality:
-                            # Keep only if it's one of the explicitly requested tags
-                            if any(it.lower() in t_lower for it in input_quality_tags):
-                                quality_tags_to_prepend.append(t)
-                        else:
-                            filtered_tags.append(t)
-                    
-                    # Ensure all input quality tags are in the prepend list
-                    for it in input_quality_tags:
-                        if not any(it.lower() in q.lower() for q in quality_tags_to_prepend):
-                            quality_tags_to_prepend.insert(0, it)
-                    
-                    # Prepend all quality tags
-                    pos = ", ".join(quality_tags_to_prepend + filtered_tags)
-                
-                else:
-                    # Even if quality_tags_enabled is False, move common quality tags to the beginning
-                    common_quality_tags = ["masterpiece", "best quality", "ultra high res", "highres", "extremely detailed", "8k", "4k"]
-                    pos_tags = [t.strip() for t in pos.split(",") if t.strip()]
-                    quality_part = []
-                    content_part = []
-                    for t in pos_tags:
-                        if any(q in t.lower() for q in common_quality_tags):
-                            quality_part.append(t)
-                        else:
-                            content_part.append(t)
-                    pos = ", ".join(quality_part + content_part)
-
-                # 2. Bottom Mandatory
-                if bottom_mandatory_enabled and bm_prompt:
-                    bm_tags = [t.strip() for t in bm_prompt.split(",") if t.strip()]
-                    pos_tags = [t.strip() for t in pos.split(",")]
-                    # Remove duplicates from current pos
-                    pos_tags = [t for t in pos_tags if not any(bt.lower() == t.lower() for bt in bm_tags)]
-                    # Append bm_tags
-                    pos = ", ".join(pos_tags + bm_tags)
-
-            pos_mapping = data.get("pos_mapping", [])
-            neg_mapping = data.get("neg_mapping", [])
-            
-            def create_mapping_html(mapping):
-                if not mapping: return ""
-                html = "<div class='translation-container'>"
-                for item in mapping:
-                    html += f"<div class='translation-item' data-word='{item['word']}'>{item['word']}: {item['translation']}</div>"
-                html += "</div>"
-                return html
+                return gr.update(visible=True, value=error_html), gr.update(), gr.update(), gr.update(value=""), gr.update(value=""), gr.update(value=format_cache_stats()), gr.update()
+
+            variants = data["variants"] if "variants" in data else [data]
+            with metrics.span("tag_postprocess"):
+                positives = [apply_prompt_settings(v.get("positive", ""), prompt_settings_enabled, quality_tags_enabled, qt_prompt, bottom_mandatory_enabled, bm_prompt) for v in variants]
+            negatives = [v.get("negative", "") for v in variants]
+
+            # The editable fields hold the first variant; the translations cover the tags of all of them
+            pos = positives[0]
+            neg = negatives[0]
+            pos_mapping = merge_mappings(v.get("pos_mapping", []) for v in variants)
+            neg_mapping = merge_mappings(v.get("neg_mapping", []) for v in variants)
+
+            with metrics.span("mapping_html"):
+                pos_html = create_mapping_html(pos_mapping)
+                neg_html = create_mapping_html(neg_mapping)
 
-            pos_html = create_mapping_html(pos_mapping)
-            neg_html = create_mapping_html(neg_mapping)
+            if len(variants) > 1:
+                variants_update = gr.update(visible=True, value=create_variants_html(positives, negatives))
+            else:
+                variants_update = gr.update(visible=False, value="")
             
-            return gr.update(visible=False, value=""), gr.update(value=pos), gr.update(value=neg), gr.update(value=pos_html), gr.update(value=neg_html)
+            return gr.update(visible=False, value=""), gr.update(value=pos), gr.update(value=neg), gr.update(value=pos_html), gr.update(value=neg_html), gr.update(value=format_cache_stats()), variants_update
+
+        def create_mapping_html(mapping):
+            # data-word is the dictionary key of the tag, which javascript/script.js looks up for the tag under the caret
+            if not mapping: return ""
+            items = "".join(
+                f"<div class='translation-item' data-word='{html.escape(tag_key(item['word']), quote=True)}'>{html.escape(item['word'])}: {html.escape(item['translation'])}</div>"
+                for item in mapping
+            )
+            return f"<div class='translation-container'>{items}</div>"
+
+        def merge_mappings(mappings):
+            merged = {}
+            for mapping in mappings:
+                for item in mapping:
+                    merged.setdefault(tag_key(item["word"]), item)
+            return list(merged.values())
+
+        def create_variants_html(positives, negatives):
+            # Each row carries its prompts in data attributes, so selection and sending stay in the browser
+            rows = ""
+            for i, (pos, neg) in enumerate(zip(positives, negatives), 1):
+                rows += (f"<tr class='aipi_variant' data-positive='{html.escape(pos, quote=True)}' data-negative='{html.escape(neg, quote=True)}'>"
+                         f"<td><input type='checkbox' class='aipi_variant_select' checked></td><td>#{i}</td>"
+                         f"<td>{html.escape(pos)}</td><td>{html.escape(neg)}</td>"
+                         f"<td><button type='button' class='aipi_variant_send' title='txt2img へ送る'>📋</button></td></tr>")
+            return ("<div class='aipi_variants'><div class='aipi_variants_toolbar'>"
+                    "<label><input type='checkbox' class='aipi_variant_select_all' checked> すべて選択</label>"
+                    "<button type='button' class='aipi_variants_send_all'>選択したバリエーションを txt2img へ一括送信</button></div>"
+                    "<table class='aipi_router_table aipi_variants_table'><tr><th></th><th></th><th>Positive</th><th>Negative</th><th></th></tr>"
+                    f"{rows}</table>"
+                    "<small>一括送信は txt2img のスクリプト「Prompts from file or textbox」の入力欄に1行ずつ書き込みます。スクリプト欄でこのスクリプトを選んでから Generate してください。</small></div>")
+
+        def format_time(created):
+            return time.strftime("%Y-%m-%d %H:%M", time.localtime(created))
+
+        def first_positive(result):
+            return (result["variants"][0] if result.get("variants") else result).get("positive", "")
+
+        def on_user_input_history(text):
+            matches = history_store.similar(text)
+            entries = {e["id"]: e for e in history_store.get_many([entry_id for _, entry_id in matches])}
+            rows, ids = [], []
+            for score, entry_id in matches:
+                entry = entries.get(entry_id)
+                if entry is not None:
+                    rows.append([f"{score:.0%}", entry["user_input"], first_positive(entry["result"]), format_time(entry["created"])])
+                    ids.append(entry_id)
+            return gr.update(visible=bool(rows), value=rows), ids
+
+        def on_history_search(query):
+            entries = history_store.search(query)
+            rows = [[format_time(e["created"]), e["user_input"], first_positive(e["result"]), e["settings"].get("llm_type", "")] for e in entries]
+            return gr.update(value=rows), [e["id"] for e in entries]
+
+        def on_history_select(ids, prompt_settings_enabled, quality_tags_enabled, bottom_mandatory_enabled, qt_prompt, bm_prompt, evt: gr.SelectData):
+            # The stored result is the model's answer, so the current prompt settings are applied to it again
+            entry = history_store.get(ids[evt.index[0]]) if evt.index[0] < len(ids) else None
+            if entry is None:
+                return [gr.update()] * 8
+            outputs = finish_generate(entry["result"], None, prompt_settings_enabled, quality_tags_enabled, bottom_mandatory_enabled, qt_prompt, bm_prompt)
+            return (*outputs[:5], gr.update(value=f"<small>履歴 ({format_time(entry['created'])}) の結果を読み込みました。</small>"), outputs[6], gr.update(value=entry["user_input"]))
+
+        def on_batch_run(llm, g_key, o_key, gr_key, prompt_settings_enabled, quality_tags_enabled, bottom_mandatory_enabled, qt_prompt, bm_prompt, bypass, input_path, output_path, workers, rpm):
+            if not input_path or not os.path.exists(input_path):
+                yield f"<span style='color: red;'>入力ファイルが見つかりません: {input_path}</span>"
+                return
+            api_key = g_key if "Gemini" in llm else (o_key if llm == "ChatGPT" else gr_key)
+            api_keys = {"gemini": g_key, "openai": o_key, "grok": gr_key}
+            failed = 0
+            yield "バッチを開始しています..."
+            for record, done, total in iter_batch(input_path, output_path, llm, api_key, workers=int(workers), requests_per_minute=(rpm or None), use_cache=not bypass, api_keys=api_keys, prompt_settings_enabled=prompt_settings_enabled, quality_tags_enabled=quality_tags_enabled, qt_prompt=qt_prompt, bottom_mandatory_enabled=bottom_mandatory_enabled, bm_prompt=bm_prompt):
+                if record.get("error"):
+                    failed += 1
+                yield f"進行状況: {done}/{total} (失敗 {failed})"
+            yield f"完了: {output_path} (失敗 {failed})"
 
         # Modal logic
         def open_preset_edit(cat):
-            ps = load_json(presets_path)
+            ps = load_presets()
             choices = [""] + list(ps.get(cat, {}).keys())
             return gr.update(visible=True), cat, gr.update(choices=choices, value=""), ""
         
@@ -231,7 +420,7 @@ def on_ui_tabs():
         bottom_mandatory_edit_btn.click(fn=open_preset_edit, inputs=[gr.State("bottom_mandatory")], outputs=[preset_edit_modal_wrapper, preset_category, preset_edit_name, preset_edit_content])
 
         def on_preset_name_input(name, cat):
-            ps = load_json(presets_path)
+            ps = load_presets()
             content = ps.get(cat, {}).get(name)
             if content is not None:
                 return content
@@ -241,10 +430,10 @@ def on_ui_tabs():
 
         def save_preset(cat, name, content):
             if not name: return [gr.update()] * 6
-            ps = load_json(presets_path)
+            ps = load_presets()
             if cat not in ps: ps[cat] = {}
             ps[cat][name] = content
-            save_json(presets_path, ps)
+            save_presets(cat, ps[cat])
             
             # Refresh choices for ALL relevant dropdowns
             qt_choices = [""] + list(ps.get("quality_tags", {}).keys())
@@ -264,10 +453,10 @@ def on_ui_tabs():
 
         def delete_preset(cat, name):
             if not name: return [gr.update()] * 6
-            ps = load_json(presets_path)
+            ps = load_presets()
             if cat in ps and name in ps[cat]:
                 del ps[cat][name]
-                save_json(presets_path, ps)
+                save_presets(cat, ps[cat])
             
             qt_choices = [""] + list(ps.get("quality_tags", {}).keys())
             bm_choices = [""] + list(ps.get("bottom_mandatory", {}).keys())
@@ -288,7 +477,7 @@ def on_ui_tabs():
         preset_close_btn.click(fn=lambda: gr.update(visible=False), outputs=[preset_edit_modal_wrapper])
 
         def on_load():
-            ps = load_json(presets_path)
+            ps = load_presets()
             qt_choices = [""] + list(ps.get("quality_tags", {}).keys())
             bm_choices = [""] + list(ps.get("bottom_mandatory", {}).keys())
             cfg = load_config()
@@ -306,32 +495,74 @@ def on_ui_tabs():
         aipi_interface.load(fn=on_load, outputs=[quality_tags_preset, bottom_mandatory_preset, quality_tags_prompt, bottom_mandatory_prompt])
 
         def update_llm_visibility(llm):
-            return gr.update(visible=("Gemini" in llm)), gr.update(visible=(llm == "ChatGPT")), gr.update(visible=(llm == "Grok"))
+            # Auto may route to any provider, so every key is needed
+            is_auto = llm == AUTO_LLM
+            return gr.update(visible=(is_auto or "Gemini" in llm)), gr.update(visible=(is_auto or llm == "ChatGPT")), gr.update(visible=(is_auto or llm == "Grok"))
         
         llm_type.change(fn=update_llm_visibility, inputs=[llm_type], outputs=[gemini_key, openai_key, grok_key])
 
         # Preset logic
         def on_preset_change(preset_name, category):
-            ps = load_json(presets_path)
+            ps = load_presets()
             return ps.get(category, {}).get(preset_name, "")
 
         quality_tags_preset.change(fn=on_preset_change, inputs=[quality_tags_preset, gr.State("quality_tags")], outputs=[quality_tags_prompt])
         bottom_mandatory_preset.change(fn=on_preset_change, inputs=[bottom_mandatory_preset, gr.State("bottom_mandatory")], outputs=[bottom_mandatory_prompt])
 
-        # Auto-save settings
-        all_settings = [llm_type, gemini_key, openai_key, grok_key, prompt_settings_enabled, quality_tags_enabled, quality_tags_preset, bottom_mandatory_enabled, bottom_mandatory_preset, user_input]
-        for s in all_settings:
-            if isinstance(s, gr.Textbox):
-                s.input(fn=save_config, inputs=all_settings, outputs=[])
+        # Auto-save settings, one handler per component that saves only its own key
+        def setting_saver(key):
+            return lambda value: save_setting(key, value)
+
+        saved_settings = {"llm_type": llm_type, "gemini_key": gemini_key, "openai_key": openai_key, "grok_key": grok_key, "prompt_settings_enabled": prompt_settings_enabled, "quality_tags_enabled": quality_tags_enabled, "quality_tags_preset": quality_tags_preset, "bottom_mandatory_enabled": bottom_mandatory_enabled, "bottom_mandatory_preset": bottom_mandatory_preset, "user_input": user_input}
+        for key, component in saved_settings.items():
+            if isinstance(component, gr.Textbox):
+                component.input(fn=setting_saver(key), inputs=[component], outputs=[])
             else:
-                s.change(fn=save_config, inputs=all_settings, outputs=[])
+                component.change(fn=setting_saver(key), inputs=[component], outputs=[])
+
+        router_refresh_btn.click(fn=format_router_stats, outputs=[router_stats_display])
+        def on_metrics_toggle(value):
+            metrics.set_enabled(value)
+            return format_timings()
+
+        metrics_enabled.change(fn=on_metrics_toggle, inputs=[metrics_enabled], outputs=[timings_display])
 
-        generate_btn.click(
+        generate_event = generate_btn.click(
             fn=on_generate,
-            inputs=[llm_type, gemini_key, openai_key, grok_key, prompt_settings_enabled, quality_tags_enabled, quality_tags_preset, bottom_mandatory_enabled, bottom_mandatory_preset, user_input, quality_tags_prompt, bottom_mandatory_prompt],
-            outputs=[error_display, pos_prompt, neg_prompt, pos_translation_display, neg_translation_display]
+            inputs=[llm_type, gemini_key, openai_key, grok_key, prompt_settings_enabled, quality_tags_enabled, quality_tags_preset, bottom_mandatory_enabled, bottom_mandatory_preset, user_input, quality_tags_prompt, bottom_mandatory_prompt, bypass_cache, streaming, race_enabled, race_hedge_delay, race_max_extra, replace_pending, variants_count],
+            outputs=[error_display, pos_prompt, neg_prompt, pos_translation_display, neg_translation_display, cache_status, variants_display]
         )
+        generate_event.then(fn=format_router_stats, outputs=[router_stats_display]).then(fn=format_timings, outputs=[timings_display]).then(fn=on_history_search, inputs=[history_search], outputs=[history_table, history_ids])
+        cancel_btn.click(fn=on_cancel, cancels=[generate_event])
+
+        user_input.input(fn=on_user_input_history, inputs=[user_input], outputs=[similar_table, similar_ids], show_progress=False)
+        history_search.input(fn=on_history_search, inputs=[history_search], outputs=[history_table, history_ids], show_progress=False)
+        history_refresh_btn.click(fn=on_history_search, inputs=[history_search], outputs=[history_table, history_ids])
+        aipi_interface.load(fn=on_history_search, inputs=[history_search], outputs=[history_table, history_ids])
+        history_select_inputs = [prompt_settings_enabled, quality_tags_enabled, bottom_mandatory_enabled, quality_tags_prompt, bottom_mandatory_prompt]
+        history_select_outputs = [error_display, pos_prompt, neg_prompt, pos_translation_display, neg_translation_display, cache_status, variants_display, user_input]
+        similar_table.select(fn=on_history_select, inputs=[similar_ids] + history_select_inputs, outputs=history_select_outputs)
+        history_table.select(fn=on_history_select, inputs=[history_ids] + history_select_inputs, outputs=history_select_outputs)
+
+        batch_run_btn.click(
+            fn=on_batch_run,
+            inputs=[llm_type, gemini_key, openai_key, grok_key, prompt_settings_enabled, quality_tags_enabled, bottom_mandatory_enabled, quality_tags_prompt, bottom_mandatory_prompt, bypass_cache, batch_input_path, batch_output_path, batch_workers, batch_rpm],
+            outputs=[batch_status]
+        )
+
+    # The history index takes a moment to build on a large history, so it is not left to the first lookup
+    threading.Thread(target=history_store.warm, daemon=True, name="aipi-history-warm").start()
+
+    startup_timings["ui"] = time.perf_counter() - ui_started
+    loaded = [p.name for p in providers() if p.loaded] or ["none"]
+    print(f"[AIPI] Startup: import {startup_timings['import'] * 1000:.0f} ms, UI build {startup_timings['ui'] * 1000:.0f} ms (provider backends loaded: {', '.join(loaded)})")
 
     return [(aipi_interface, "AIPI", "aipi_tab")]
 
+def on_app_started(demo, app):
+    # Prometheus text exposition of the stage timings and counters
+    from fastapi.responses import PlainTextResponse
+    app.add_api_route("/aipi/metrics", lambda: PlainTextResponse(metrics.prometheus_text(), media_type="text/plain; version=0.0.4"), methods=["GET"])
+
 script_callbacks.on_ui_tabs(on_ui_tabs)
+script_callbacks.on_app_started(on_app_started)
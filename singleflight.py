@@ -0,0 +1,163 @@
+import asyncio
+import threading
+
+SUPERSEDED_ERROR = "Superseded by a newer request from the same session."
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        # Set once every caller waiting on this flight has gone, so the work itself can stop
+        self.cancelled = threading.Event()
+        self.result = None
+        self.waiters = 0
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution and all receive its result
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        # Returns (flight, is_leader); the leader must call complete() exactly once
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self._flights[key] = flight
+            flight.waiters += 1
+            return flight, leader
+
+    def complete(self, key, flight, result):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.result = result
+        flight.done.set()
+
+    def leave(self, flight):
+        with self._lock:
+            flight.waiters -= 1
+            if flight.waiters <= 0 and not flight.done.is_set():
+                flight.cancelled.set()
+
+    def wait(self, flight, cancel_event=None):
+        # Returns the shared result, or None if cancel_event fired first
+        try:
+            while not flight.done.wait(0.05):
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+            return flight.result
+        finally:
+            self.leave(flight)
+
+    def do(self, key, fn, cancel_event=None):
+        # fn(flight_cancelled) runs on its own thread so that any caller can stop waiting early
+        flight, leader = self.join(key)
+        if leader:
+            def run():
+                try:
+                    result = fn(flight.cancelled)
+                except Exception as e:
+                    result = (None, f"Unexpected error: {e}")
+                self.complete(key, flight, result)
+            threading.Thread(target=run, daemon=True, name="aipi-flight").start()
+        return self.wait(flight, cancel_event)
+
+class SessionRequests:
+    # Cancel-and-replace: a new request from a session cancels that session's pending one
+    def __init__(self):
+        self._current = {}
+        self._lock = threading.Lock()
+
+    def start(self, session_id):
+        event = threading.Event()
+        with self._lock:
+            previous = self._current.get(session_id)
+            self._current[session_id] = event
+        if previous is not None:
+            previous.set()
+        return event
+
+    def finish(self, session_id, event):
+        with self._lock:
+            if self._current.get(session_id) is event:
+                del self._current[session_id]
+
+    def cancel(self, session_id):
+        with self._lock:
+            event = self._current.pop(session_id, None)
+        if event is not None:
+            event.set()
+
+class AsyncFlight:
+    def __init__(self, future):
+        self.future = future
+        self.waiters = 0
+
+class AsyncSingleFlight:
+    # SingleFlight for coroutines. Everything runs on one event loop, so no locking is needed.
+    def __init__(self):
+        self._flights = {}
+
+    def join(self, key):
+        # For leaders that produce the result themselves (streaming): returns (flight, is_leader).
+        # The leader must call complete() once, with None if it gave up, and leave() when done.
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = AsyncFlight(asyncio.get_running_loop().create_future())
+            self._flights[key] = flight
+        flight.waiters += 1
+        return flight, leader
+
+    def complete(self, key, flight, result):
+        self._forget(key, flight)
+        if not flight.future.done():
+            flight.future.set_result(result)
+
+    def leave(self, flight):
+        flight.waiters -= 1
+        if flight.waiters <= 0 and not flight.future.done():
+            # Nobody is waiting any more; cancelling aborts the request in flight
+            flight.future.cancel()
+
+    async def wait(self, flight):
+        try:
+            # Shielded, so one caller giving up does not cancel the work for the others
+            return await asyncio.shield(flight.future)
+        finally:
+            self.leave(flight)
+
+    async def do(self, key, coro_fn):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = AsyncFlight(asyncio.ensure_future(coro_fn()))
+            self._flights[key] = flight
+            flight.future.add_done_callback(lambda _: self._forget(key, flight))
+        flight.waiters += 1
+        return await self.wait(flight)
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+class AsyncSessionRequests:
+    # Cancel-and-replace for the async entry points: start() calls the previous request's cancel callback
+    def __init__(self):
+        self._current = {}
+
+    def start(self, session_id, cancel):
+        previous = self._current.get(session_id)
+        self._current[session_id] = cancel
+        if previous is not None:
+            previous()
+
+    def finish(self, session_id, cancel):
+        if self._current.get(session_id) is cancel:
+            del self._current[session_id]
+
+    def cancel(self, session_id):
+        cancel = self._current.pop(session_id, None)
+        if cancel is not None:
+            cancel()
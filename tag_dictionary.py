@@ -0,0 +1,155 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+dictionary_path = os.path.join(base_dir, "tag_dictionary.json")
+
+# How many of the most used known tags are listed in the prompt as "already translated"
+MAX_PROMPT_TAGS = 200
+SAVE_INTERVAL_SECONDS = 5.0
+# The known-tags list is part of the cacheable prompt prefix, so it is rebuilt at most this often
+PROMPT_TAGS_REFRESH_SECONDS = 30 * 60
+
+_WEIGHT = re.compile(r"^[\(\[\{]+|[\)\]\}]+$|:\s*-?[\d.]+\s*[\)\]\}]*$")
+
+def tag_key(tag):
+    # "(Best_Quality:1.2)" and "best quality" are the same dictionary entry
+    tag = unicodedata.normalize("NFKC", tag).replace("_", " ")
+    tag = _WEIGHT.sub("", tag.strip())
+    return " ".join(tag.lower().split())
+
+def split_tags(prompt):
+    return [t.strip() for t in (prompt or "").split(",") if t.strip()]
+
+def estimate_tokens(text):
+    # Roughly 4 ASCII characters per token, about one token per Japanese character
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars / 4 + (len(text) - ascii_chars)
+
+class TagDictionary:
+    # English tag -> Japanese translation, learned from every parsed response.
+    # Known tags are translated locally, so the model only has to translate new ones.
+    def __init__(self, path):
+        self.path = path
+        self._entries = None # key -> {"word", "translation", "count"}
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+        self._dirty = False
+        self._prompt_tags = None
+        self._prompt_tags_at = 0.0
+        self._prompt_tags_stale = False
+        self.lookups = 0
+        self.hits = 0
+        self.tokens_saved = 0.0
+
+    def _load(self):
+        # Caller must hold the lock
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f) or {}
+            except Exception as e:
+                print(f"[AIPI] Error loading tag dictionary from {self.path}: {e}")
+
+    def _save(self, force=False):
+        # Caller must hold the lock
+        now = time.time()
+        if not self._dirty or (not force and now - self._last_save < SAVE_INTERVAL_SECONDS):
+            return
+        self._last_save = now
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, indent=1, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except Exception as e:
+            print(f"[AIPI] Error saving tag dictionary to {self.path}: {e}")
+
+    def prompt_tags(self):
+        # Most used known tags, for the slim prompt variant; None while the dictionary is empty.
+        # New tags are picked up on the next refresh, not on every call, so the prompt prefix stays the same.
+        with self._lock:
+            self._load()
+            now = time.time()
+            if self._prompt_tags is None or (self._prompt_tags_stale and (not self._prompt_tags or now - self._prompt_tags_at >= PROMPT_TAGS_REFRESH_SECONDS)):
+                entries = sorted(self._entries.values(), key=lambda e: (-e.get("count", 0), e["word"]))
+                self._prompt_tags = [e["word"] for e in entries[:MAX_PROMPT_TAGS]]
+                self._prompt_tags_at = now
+                self._prompt_tags_stale = False
+            return self._prompt_tags or None
+
+    def complete(self, data):
+        # Learns the mappings the model returned and fills in the ones it left out. Returns data.
+        if "variants" in data:
+            for variant in data["variants"]:
+                self.complete(variant)
+            return data
+        with self._lock:
+            self._load()
+            for field, mapping_field in (("positive", "pos_mapping"), ("negative", "neg_mapping")):
+                returned = {}
+                for item in data.get(mapping_field) or []:
+                    key = tag_key(item["word"])
+                    if key and item["translation"]:
+                        returned[key] = (item["word"], item["translation"])
+
+                mapping = []
+                for tag in split_tags(data.get(field)):
+                    key = tag_key(tag)
+                    # Looked up before learning this response, so the hit rate reflects what was already known
+                    entry = self._entries.get(key)
+                    self.lookups += 1
+                    if entry is not None:
+                        self.hits += 1
+                    if key in returned:
+                        entry = self._learn(key, *returned[key])
+                    elif entry is not None:
+                        self.tokens_saved += estimate_tokens(json.dumps({"word": tag, "translation": entry["translation"]}, ensure_ascii=False))
+                    if entry is not None:
+                        entry["count"] = entry.get("count", 0) + 1
+                        self._dirty = True
+                        mapping.append({"word": tag, "translation": entry["translation"]})
+                data[mapping_field] = mapping
+            self._save()
+        return data
+
+    def _learn(self, key, word, translation):
+        # Caller must hold the lock
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {"word": word, "translation": translation, "count": 0}
+            self._prompt_tags_stale = True
+            self._dirty = True
+        elif entry["translation"] != translation:
+            # The latest translation wins; the model tends to refine rather than regress
+            entry["translation"] = translation
+            self._dirty = True
+        return entry
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {
+                "entries": len(self._entries),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "tokens_saved": int(self.tokens_saved),
+            }
+
+    def flush(self):
+        with self._lock:
+            if self._entries is not None:
+                self._save(force=True)
+
+tag_dictionary = TagDictionary(dictionary_path)
+atexit.register(tag_dictionary.flush)
@@ -0,0 +1,75 @@
+import re
+from functools import lru_cache
+
+COMMON_QUALITY_TAGS = ["masterpiece", "best quality", "ultra high res", "highres", "extremely detailed", "8k", "4k"]
+
+_SPACES = re.compile(r"\s+")
+
+def _alternation(words):
+    # One compiled automaton instead of an any() scan per word; longest first so overlaps still match
+    words = sorted({w for w in words if w}, key=len, reverse=True)
+    return re.compile("|".join(re.escape(w) for w in words)) if words else None
+
+_COMMON_QUALITY = _alternation(COMMON_QUALITY_TAGS)
+
+def tokenize(prompt):
+    # Split once, normalize whitespace and drop empty and duplicate tags (case-insensitive, first one wins)
+    tags = []
+    seen = set()
+    for raw in (prompt or "").split(","):
+        tag = _SPACES.sub(" ", raw).strip()
+        key = tag.lower()
+        if tag and key not in seen:
+            seen.add(key)
+            tags.append(tag)
+    return tags
+
+class CompiledRules:
+    def __init__(self, qt_prompt=None, bm_prompt=None):
+        # qt_prompt: fixed quality tags, or None to only move quality tags to the front
+        # bm_prompt: bottom mandatory tags, or None
+        self.fixed_quality = qt_prompt is not None
+        self.quality_tags = tokenize(qt_prompt)
+        self.quality_keys = {t.lower() for t in self.quality_tags}
+        self.requested = _alternation(self.quality_keys)
+        self.bottom_tags = tokenize(bm_prompt)
+        self.bottom_keys = {t.lower() for t in self.bottom_tags}
+
+    def apply(self, pos):
+        quality_part = []
+        content_part = []
+        for tag in tokenize(pos):
+            lower = tag.lower()
+            if lower in self.bottom_keys:
+                continue # Re-appended at the end
+            if lower in self.quality_keys:
+                # Requested by name: it belongs with the quality tags wherever the model put it
+                quality_part.append(tag)
+            elif _COMMON_QUALITY.search(lower):
+                # With fixed quality tags, only the explicitly requested ones survive
+                if not self.fixed_quality or (self.requested and self.requested.search(lower)):
+                    quality_part.append(tag)
+            else:
+                content_part.append(tag)
+
+        if self.fixed_quality:
+            # Requested quality tags the model left out go first, in the order they were given
+            kept = {t.lower() for t in quality_part}
+            missing = [t for t in self.quality_tags if t.lower() not in kept and t.lower() not in self.bottom_keys]
+            quality_part = missing + quality_part
+
+        return ", ".join(quality_part + content_part + self.bottom_tags)
+
+@lru_cache(maxsize=64)
+def compile_rules(qt_prompt=None, bm_prompt=None):
+    return CompiledRules(qt_prompt, bm_prompt)
+
+def apply_prompt_settings(pos, prompt_settings_enabled, quality_tags_enabled, qt_prompt, bottom_mandatory_enabled, bm_prompt):
+    # Apply Prompt Settings only if master toggle is enabled
+    if not prompt_settings_enabled:
+        return pos
+    rules = compile_rules(
+        qt_prompt if (quality_tags_enabled and qt_prompt) else None,
+        bm_prompt if (bottom_mandatory_enabled and bm_prompt) else None,
+    )
+    return rules.apply(pos)